@@ -0,0 +1,311 @@
+"""Бенчмарки основных функций репозитория на синтетических данных.
+
+Примеры запуска:
+    python benchmark.py --scales 10k 100k
+    python benchmark.py --scales 1m --stages --save baseline.json
+    python benchmark.py --scales 1m --compare baseline.json --tolerance 0.2
+
+Для каждой функции и каждого масштаба выводятся время (минимум по повторам), пропускная
+способность (строк в секунду) и пиковая память, выделенная во время вызова (tracemalloc).
+Память учитывается только в текущем процессе, при --n-jobs память воркеров не видна.
+С флагом --stages дополнительно выводятся замеры этапов внутри функций (profiling.stage).
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from profiling import record_stages
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SCALES = {'10k': 10 ** 4, '100k': 10 ** 5, '1m': 10 ** 6, '10m': 10 ** 7}
+PERIODS = {
+    'prepilot': {'begin': '2020-01-01', 'end': '2020-01-15'},
+    'pilot': {'begin': '2020-01-15', 'end': '2020-01-29'},
+}
+
+
+@lru_cache(maxsize=None)
+def load_module(file_name):
+    """Загружает модуль из файла, название которого не является идентификатором (например, first-type-error.py)."""
+    name = os.path.splitext(file_name)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_events(n_events, n_users, seed=0):
+    """Генерирует события пользователей за 28 дней.
+
+    n_events - int, кол-во строк
+    n_users - int, кол-во пользователей
+    seed - int, состояние генератора случайных чисел
+
+    return - pd.DataFrame со столбцами ['user_id', 'date', 'value', 'sale_id']
+    """
+    rng = np.random.default_rng(seed)
+    dates = np.datetime64('2020-01-01') + rng.integers(0, 28, n_events).astype('timedelta64[D]')
+    return pd.DataFrame({
+        'user_id': rng.integers(0, n_users, n_events),
+        'date': dates.astype('datetime64[ns]'),
+        'value': rng.lognormal(5, 1, n_events).round(2),
+        # в среднем по 3 товара в покупке
+        'sale_id': rng.integers(0, max(n_events // 3, 1), n_events),
+    })
+
+
+def generate_users(n_users, seed=0):
+    """Генерирует атрибуты пользователей для стратификации.
+
+    return - pd.DataFrame со столбцами ['user_id', 'os', 'gender', 'age_group', 'value']
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': np.arange(n_users),
+        'os': rng.choice(['android', 'ios', 'web'], n_users, p=[0.5, 0.3, 0.2]),
+        'gender': rng.choice(['man', 'woman'], n_users),
+        'age_group': rng.integers(0, 5, n_users),
+        'value': rng.lognormal(5, 1, n_users),
+    })
+
+
+def generate_experiments(n_experiments=50, n_slots=100, seed=0):
+    """Генерирует эксперименты со случайными конфликтами для ABSplitter."""
+    rng = np.random.default_rng(seed)
+    ids = [f'exp_{i}' for i in range(n_experiments)]
+    return [
+        {
+            'experiment_id': exp_id,
+            'count_slots': int(rng.integers(1, n_slots // 5)),
+            'conflict_experiments': [ids[j] for j in rng.choice(n_experiments, 3, replace=False) if ids[j] != exp_id],
+        }
+        for exp_id in ids
+    ]
+
+
+def build_cases(n, n_iter, n_jobs, max_loop):
+    """Возвращает словарь {название: prepare}, где prepare() -> (кол-во обработанных строк, функция без аргументов).
+
+    Данные генерируются лениво при первом вызове prepare нужного случая и переиспользуются
+    остальными случаями того же масштаба. prepare вызывается перед каждым повтором и не входит в замер.
+
+    n - int, масштаб: кол-во событий и пользователей
+    n_iter - int, кол-во итераций бутстрепа
+    n_jobs - int or None, кол-во процессов для бутстрепа, None - последовательный расчёт
+    max_loop - int, максимальное кол-во пользователей для поштучного assign_user
+    """
+    @lru_cache(maxsize=None)
+    def get_events():
+        return generate_events(n, max(n // 10, 1))
+
+    @lru_cache(maxsize=None)
+    def get_users():
+        return generate_users(n)
+
+    def get_groups():
+        half = n // 2
+        return get_users().iloc[half:2 * half], get_users().iloc[:half]
+
+    def get_list_user_id():
+        return get_users()['user_id'].iloc[:max(n // 10, 1)].to_numpy()
+
+    @lru_cache(maxsize=None)
+    def get_splitter():
+        splitter = load_module('experiment-to-slot.py').ABSplitter(100, 'salt_one', 'salt_two')
+        splitter.split_experiments(generate_experiments())
+        return splitter
+
+    @lru_cache(maxsize=None)
+    def get_user_ids():
+        return get_users()['user_id'].astype(str).to_numpy()
+
+    def prepare_first_type_error():
+        df_pilot, df_control = get_groups()
+        module = load_module('first-type-error.py')
+        return len(df_pilot) * 2 * n_iter, lambda: module.estimate_first_type_error(
+            df_pilot, df_control, 'value', n_iter=n_iter, seed=0, n_jobs=n_jobs
+        )
+
+    def prepare_second_type_error():
+        df_pilot, df_control = get_groups()
+        module = load_module('second-type-error.py')
+        return len(df_pilot) * 2 * n_iter, lambda: module.estimate_second_type_error(
+            df_pilot, df_control, 'value', [1.01, 1.03, 1.05], n_iter=n_iter, seed=0, n_jobs=n_jobs
+        )
+
+    def prepare_assign_user():
+        # новый снимок с пустым кешем на каждый повтор, иначе со второго повтора замеряются попадания в кеш
+        splitter = get_splitter()
+        routing_table = load_module('experiment-to-slot.py').RoutingTable(
+            splitter.slot_to_experiments, splitter.salt_one, splitter.salt_two
+        )
+        loop_ids = get_user_ids()[:max_loop]
+        return len(loop_ids), lambda: [routing_table.assign(user_id) for user_id in loop_ids]
+
+    def prepare_assign_user_cached():
+        routing_table = get_splitter().routing_table
+        loop_ids = get_user_ids()[:max_loop]
+        for user_id in loop_ids:
+            routing_table.assign(user_id)
+        return len(loop_ids), lambda: [routing_table.assign(user_id) for user_id in loop_ids]
+
+    def prepare_process_users():
+        splitter, user_ids = get_splitter(), get_user_ids()
+        return len(user_ids), lambda: splitter.process_users(user_ids)
+
+    def prepare_select_stratified_groups():
+        import stratification
+        users = get_users()
+        return len(users), lambda: stratification.select_stratified_groups(
+            users, ['os', 'gender', 'age_group'], max(n // 10, 1), seed=0
+        )
+
+    def prepare_calculate_metric_cuped():
+        import cuped
+        events, list_user_id = get_events(), get_list_user_id()
+        return len(events), lambda: cuped.calculate_metric_cuped(
+            events, 'value', 'user_id', list_user_id, 'date', PERIODS, 'value'
+        )
+
+    def prepare_calculate_linearized_metric():
+        import linearization
+        events, list_user_id = get_events(), get_list_user_id()
+        return len(events), lambda: linearization.calculate_linearized_metric(
+            events, 'value', 'user_id', list_user_id, 'date', PERIODS['pilot'], 'value'
+        )
+
+    def prepare_calculate_sales_metrics():
+        module = load_module('metrics-calc.py')
+        events = get_events()
+        return len(events), lambda: module.calculate_sales_metrics(
+            events, 'value', 'date', 'sale_id', PERIODS['pilot']
+        )
+
+    return {
+        'first_type_error': prepare_first_type_error,
+        'second_type_error': prepare_second_type_error,
+        'assign_user': prepare_assign_user,
+        'assign_user_cached': prepare_assign_user_cached,
+        'process_users': prepare_process_users,
+        'select_stratified_groups': prepare_select_stratified_groups,
+        'calculate_metric_cuped': prepare_calculate_metric_cuped,
+        'calculate_linearized_metric': prepare_calculate_linearized_metric,
+        'calculate_sales_metrics': prepare_calculate_sales_metrics,
+    }
+
+
+def run_case(prepare, repeat, with_memory, with_stages):
+    """Замеряет время, пиковую память и время этапов одного вызова.
+
+    prepare - функция без аргументов, возвращает (кол-во строк, функция для замера),
+        вызывается перед каждым повтором
+
+    return - dict, {'rows': ..., 'seconds': ..., 'peak_memory_mb': ..., 'stages': {этап: секунды}}
+    """
+    seconds = []
+    stages = {}
+    for _ in range(repeat):
+        n_rows, func = prepare()
+        if not with_stages:
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+            continue
+        with record_stages() as timings:
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+        # этапы берём из самого быстрого повтора
+        if seconds[-1] == min(seconds):
+            stages = {name: sum(values) for name, values in timings.items()}
+
+    peak_memory = None
+    if with_memory:
+        # отдельный прогон, так как tracemalloc замедляет выполнение
+        n_rows, func = prepare()
+        tracemalloc.start()
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return {'rows': n_rows, 'seconds': min(seconds), 'peak_memory_mb': peak_memory, 'stages': stages}
+
+
+def compare_results(results, baseline, tolerance):
+    """Сравнивает время с сохранёнными результатами.
+
+    results, baseline - dict, {масштаб: {функция: результат run_case}}
+    tolerance - float, допустимое относительное замедление, например 0.2 - на 20%
+
+    return - List[str], описания регрессий
+    """
+    regressions = []
+    for scale, cases in results.items():
+        for name, res in cases.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            ratio = res['seconds'] / base['seconds']
+            status = 'REGRESSION' if ratio > 1 + tolerance else 'ok'
+            print(f'{scale:>5} {name:<28} {base["seconds"]:9.3f}s -> {res["seconds"]:9.3f}s  x{ratio:5.2f}  {status}')
+            if status != 'ok':
+                regressions.append(f'{scale} {name}: x{ratio:.2f}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=['10k', '100k'], choices=list(SCALES))
+    parser.add_argument('--cases', nargs='+', default=None, help='названия случаев, по умолчанию все')
+    parser.add_argument('--n-iter', type=int, default=100, help='кол-во итераций бутстрепа')
+    parser.add_argument('--n-jobs', type=int, default=None, help='кол-во процессов для бутстрепа')
+    parser.add_argument('--max-loop', type=int, default=100000, help='кол-во пользователей для assign_user')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='не замерять пиковую память')
+    parser.add_argument('--stages', action='store_true', help='выводить время этапов внутри функций')
+    parser.add_argument('--save', help='путь к json-файлу для сохранения результатов')
+    parser.add_argument('--compare', help='путь к json-файлу с результатами для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scale in args.scales:
+        results[scale] = {}
+        cases = build_cases(SCALES[scale], args.n_iter, args.n_jobs, args.max_loop)
+        for name, prepare in cases.items():
+            if args.cases and name not in args.cases:
+                continue
+            res = run_case(prepare, args.repeat, not args.no_memory, args.stages)
+            res['rows_per_second'] = res['rows'] / res['seconds']
+            results[scale][name] = res
+
+            memory = '' if res['peak_memory_mb'] is None else f'{res["peak_memory_mb"]:9.1f} MB'
+            print(f'{scale:>5} {name:<28} {res["seconds"]:9.3f}s {res["rows_per_second"]:14,.0f} rows/s {memory}')
+            for stage_name, seconds in res['stages'].items():
+                print(f'{"":>5}   {stage_name:<26} {seconds:9.3f}s')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions:', ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.stats import beta, norm
 def get_bernoulli_confidence_interval(values: np.array):
     """Вычисляет доверительный интервал для параметра распределения Бернулли.
 
@@ -13,4 +14,55 @@ def get_bernoulli_confidence_interval(values: np.array):
     
     if right_bound > 1: right_bound = 1
         
-    return left_bound, right_bound
\ No newline at end of file
+    return left_bound, right_bound
+
+
+def get_bernoulli_confidence_intervals(successes, trials, method='normal', alpha=0.05, z=None):
+    """Вычисляет доверительные интервалы для параметров распределения Бернулли сразу для многих выборок.
+
+    Каждая выборка задаётся только кол-вом успехов и кол-вом испытаний.
+
+    :param successes: массив кол-ва единиц в выборках.
+    :param trials: массив размеров выборок.
+    :param method: способ построения интервала:
+        'normal' - нормальная аппроксимация, как в get_bernoulli_confidence_interval.
+            Квантиль norm.ppf(0.975) = 1.959964 отличается от 1.96, поэтому при alpha=0.05 границы
+            расходятся с get_bernoulli_confidence_interval в 6-м знаке; для точного совпадения передайте z=1.96,
+        'wilson' - интервал Уилсона,
+        'exact' - точный интервал Клоппера-Пирсона.
+    :param alpha: уровень значимости, интервал покрывает параметр с вероятностью 1 - alpha.
+    :param z: квантиль нормального распределения. Если None, то norm.ppf(1 - alpha / 2),
+        иначе используется вместо alpha во всех методах.
+    :return (left_bounds, right_bounds): массивы границ доверительных интервалов.
+    """
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    if z is None:
+        z = norm.ppf(1 - alpha / 2)
+    else:
+        alpha = 2 * norm.sf(z)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = successes / trials
+        if method == 'normal':
+            half_width = z * np.sqrt(p * (1 - p) / trials)
+            left_bounds = np.clip(p - half_width, 0, 1)
+            right_bounds = np.clip(p + half_width, 0, 1)
+        elif method == 'wilson':
+            denominator = 1 + z ** 2 / trials
+            center = (p + z ** 2 / (2 * trials)) / denominator
+            half_width = z / denominator * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2))
+            left_bounds = center - half_width
+            right_bounds = center + half_width
+        elif method == 'exact':
+            left_bounds = np.where(
+                successes > 0, beta.ppf(alpha / 2, successes, trials - successes + 1), 0.0
+            )
+            right_bounds = np.where(
+                successes < trials, beta.ppf(1 - alpha / 2, successes + 1, trials - successes), 1.0
+            )
+            left_bounds = np.where(trials > 0, left_bounds, np.nan)
+            right_bounds = np.where(trials > 0, right_bounds, np.nan)
+        else:
+            raise ValueError(f'Unknown method: {method}')
+    return left_bounds, right_bounds
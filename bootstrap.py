@@ -0,0 +1,359 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.stats import t as t_distribution
+
+
+def _accumulate_moments(chunks, n_iter):
+    """Накапливает средние и несмещённые дисперсии столбцов по блокам строк.
+
+    chunks - iterable of np.array, блоки строк матрицы формы (size, n_iter)
+    n_iter - int, кол-во столбцов
+
+    return - (mean, var), np.array длины n_iter
+    """
+    mean = np.zeros(n_iter)
+    m2 = np.zeros(n_iter)
+    count = 0
+    for chunk in chunks:
+        size = len(chunk)
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        new_count = count + size
+        delta = chunk_mean - mean
+        mean += delta * size / new_count
+        m2 += chunk_m2 + delta ** 2 * count * size / new_count
+        count = new_count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = m2 / (count - 1)
+    return mean, var
+
+
+def calculate_bootstrap_moments(values, n_iter, chunk_size=1000):
+    """Вычисляет средние и дисперсии бутстрепных выборок без построения матрицы (n, n_iter).
+
+    Матрица бутстрепа генерируется блоками по chunk_size строк тем же вызовом np.random.choice,
+    что и раньше, поэтому при фиксированном seed получаются те же самые выборки.
+    Моменты столбцов накапливаются между блоками (объединение средних и сумм квадратов отклонений).
+
+    values - np.array, значения метрики, из которых семплируем
+    n_iter - int, кол-во итераций бутстрапа (столбцов матрицы)
+    chunk_size - int, кол-во строк матрицы бутстрапа, которые генерируются за раз.
+        Пиковая память ~ chunk_size * n_iter.
+
+    return - (mean, var), np.array длины n_iter со средними и несмещёнными дисперсиями столбцов
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    n = len(values)
+    chunks = (
+        np.random.choice(values, size=(min(chunk_size, n - begin), n_iter))
+        for begin in range(0, n, chunk_size)
+    )
+    return _accumulate_moments(chunks, n_iter)
+
+
+def _get_block_size(n, block_size=None, max_block_elements=10000000):
+    """Кол-во итераций в блоке: block_size или, если None, столько, чтобы блок (block_size, n)
+    содержал не больше max_block_elements элементов."""
+    if block_size is None:
+        block_size = max(1, max_block_elements // max(n, 1))
+    return block_size
+
+
+def _draw_bootstrap_block(rng, n, size, method):
+    """Генерирует один блок бутстрепа из size итераций по выборке размера n."""
+    if method == 'index':
+        dtype = np.uint32 if n <= np.iinfo(np.uint32).max else np.int64
+        return rng.integers(0, n, size=(size, n), dtype=dtype)
+    if method == 'poisson':
+        # rng.poisson возвращает int64, поэтому генерируем по строке в заранее выделенный uint8 блок,
+        # последовательность значений та же, что и при генерации всего блока за раз
+        block = np.empty((size, n), dtype=np.uint8)
+        for row in block:
+            row[:] = rng.poisson(1, size=n)
+        return block
+    raise ValueError(f'Unknown bootstrap method: {method}')
+
+
+def _weighted_sums(weights, columns):
+    """Вычисляет weights @ columns, приводя целочисленные веса к float частями по строкам.
+
+    Временный float-массив занимает не больше памяти, чем сам блок весов uint8.
+    """
+    step = max(1, len(weights) // 8)
+    return np.concatenate([
+        weights[begin:begin + step].astype(float) @ columns
+        for begin in range(0, len(weights), step)
+    ])
+
+
+def generate_bootstrap_samples(n, n_iter, block_size=None, method='index', seed=None):
+    """Генератор бутстрепных выборок блоками итераций.
+
+    Матрица бутстрепа целиком не строится: за раз в памяти находится один блок
+    формы (block_size, n), пиковая память задаётся block_size * n, а не n_iter * n.
+    У каждого блока свой генератор, порождённый из seed, поэтому любой блок можно
+    воспроизвести отдельно (например, в другом процессе).
+
+    n - int, размер исходной выборки
+    n_iter - int, кол-во итераций бутстрапа
+    block_size - int or None, кол-во итераций в одном блоке. Если None, то подбирается так,
+        чтобы в блоке было не больше 10 млн элементов.
+    method - str, способ семплирования:
+        'index' - блок индексов элементов выборки (uint32, если позволяет размер выборки),
+        'poisson' - блок весов пуассоновского бутстрапа, веса ~ Poisson(1).
+    seed - int, None or np.random.SeedSequence, состояние генератора случайных чисел
+
+    yield - np.array формы (size, n), строка - одна итерация бутстрапа
+    """
+    if method not in ('index', 'poisson'):
+        raise ValueError(f'Unknown bootstrap method: {method}')
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    block_size = _get_block_size(n, block_size)
+    sizes = [min(block_size, n_iter - begin) for begin in range(0, n_iter, block_size)]
+    for size, seed_sequence in zip(sizes, seed.spawn(len(sizes))):
+        yield _draw_bootstrap_block(np.random.default_rng(seed_sequence), n, size, method)
+
+
+def calculate_sample_moments(values, sample, method='index'):
+    """Вычисляет моменты метрики для блока бутстрепных выборок.
+
+    values - np.array, значения метрики
+    sample - np.array формы (size, n), блок из generate_bootstrap_samples
+    method - str, способ семплирования, которым получен блок ('index' или 'poisson')
+
+    return - (mean, var, count), np.array длины size со средними, несмещёнными дисперсиями
+        и размерами бутстрепных выборок
+    """
+    if method == 'index':
+        sample_values = values[sample]
+        count = np.full(len(sample), sample.shape[1])
+        return sample_values.mean(axis=1), sample_values.var(axis=1, ddof=1), count
+    # центрируем значения, чтобы не терять точность при вычитании квадратов
+    shift = values.mean()
+    centered = values - shift
+    count = sample.sum(axis=1, dtype=np.int64)
+    sums, sums_sq = _weighted_sums(sample, np.column_stack([centered, centered ** 2])).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / count
+        var = (sums_sq - count * mean ** 2) / (count - 1)
+    return mean + shift, var, count
+
+
+def _calculate_block_moments(values, size, seed_sequence, method):
+    """Моменты бутстрепа для одного блока итераций с собственным генератором."""
+    rng = np.random.default_rng(seed_sequence)
+    sample = _draw_bootstrap_block(rng, len(values), size, method)
+    return calculate_sample_moments(values, sample, method)
+
+
+_shared_values = {}
+
+
+def _init_worker(shm_name, n_a, n_b):
+    """Подключает процесс-воркер к общей памяти с исходными значениями метрики."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    values = np.ndarray((n_a + n_b,), dtype=float, buffer=shm.buf)
+    _shared_values['shm'] = shm
+    _shared_values['a'] = values[:n_a]
+    _shared_values['b'] = values[n_a:]
+
+
+def _calculate_shared_block_moments(task):
+    """Моменты бутстрепа для блока итераций по значениям из общей памяти."""
+    group, size, seed_sequence, method = task
+    return _calculate_block_moments(_shared_values[group], size, seed_sequence, method)
+
+
+def calculate_bootstrap_moments_parallel(
+    values_a, values_b, n_iter, seed=None, n_jobs=1, block_size=None, method='index'
+):
+    """Вычисляет моменты бутстрепных выборок двух групп в нескольких процессах.
+
+    Итерации делятся на блоки по block_size, у каждого блока свой генератор, порождённый
+    из np.random.SeedSequence(seed) так же, как в generate_bootstrap_samples, поэтому результат
+    не зависит от кол-ва процессов. Исходные значения передаются воркерам через общую память,
+    обратно возвращаются только моменты блоков.
+
+    values_a - np.array, значения метрики первой группы
+    values_b - np.array, значения метрики второй группы
+    n_iter - int, кол-во итераций бутстрапа
+    seed - int or None, состояние генератора случайных чисел
+    n_jobs - int, кол-во процессов. Если -1, то по числу ядер.
+    block_size - int or None, кол-во итераций в одном блоке. Если None, то подбирается по размеру
+        большей группы так, чтобы в блоке было не больше 10 млн элементов.
+    method - str, способ семплирования, 'index' или 'poisson', см. generate_bootstrap_samples
+
+    return - (a_mean, a_var, a_count, b_mean, b_var, b_count), np.array длины n_iter
+    """
+    values = {
+        'a': np.asarray(values_a, dtype=float).ravel(),
+        'b': np.asarray(values_b, dtype=float).ravel(),
+    }
+    seed_sequences = dict(zip(values, np.random.SeedSequence(seed).spawn(2)))
+    block_size = _get_block_size(max(len(values['a']), len(values['b'])), block_size)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    if n_jobs == 1:
+        moments = {
+            group: [
+                calculate_sample_moments(values[group], sample, method)
+                for sample in generate_bootstrap_samples(
+                    len(values[group]), n_iter, block_size, method, seed_sequences[group]
+                )
+            ]
+            for group in values
+        }
+    else:
+        sizes = [min(block_size, n_iter - begin) for begin in range(0, n_iter, block_size)]
+        tasks = [
+            (group, size, seed_sequence, method)
+            for group in values
+            for size, seed_sequence in zip(sizes, seed_sequences[group].spawn(len(sizes)))
+        ]
+        n_a, n_b = len(values['a']), len(values['b'])
+        shm = shared_memory.SharedMemory(create=True, size=max((n_a + n_b) * 8, 1))
+        try:
+            shared = np.ndarray((n_a + n_b,), dtype=float, buffer=shm.buf)
+            shared[:n_a] = values['a']
+            shared[n_a:] = values['b']
+            del shared
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker, initargs=(shm.name, n_a, n_b)
+            ) as executor:
+                results = list(executor.map(_calculate_shared_block_moments, tasks))
+        finally:
+            shm.close()
+            shm.unlink()
+        moments = {'a': results[:len(sizes)], 'b': results[len(sizes):]}
+    return tuple(
+        np.concatenate(moment) for group in values for moment in zip(*moments[group])
+    )
+
+
+def calculate_poisson_bootstrap_moments(sums, counts=None, n_iter=10000, block_size=None, seed=None):
+    """Вычисляет моменты пуассоновского бутстрепа по поюзерным агрегатам.
+
+    Вместо сырых значений используются достаточные статистики пользователей, например столбцы
+    period_name и f'{period_name}_count' из cuped.calculate_period_metrics(..., with_count=True)
+    или 'sum' и 'count' из DailyAggregateStore.get_user_aggregates.
+    Для каждого блока итераций считается произведение матрицы весов Poisson(1) формы
+    (block_size, n) на матрицу агрегатов формы (n, k), веса приводятся к float частями по строкам.
+
+    Если counts не задан, то метрика - среднее sums по пользователям, иначе ratio-метрика
+    sum(sums) / sum(counts). Для ratio-метрики дисперсия считается дельта-методом:
+    возвращается дисперсия линеаризованной метрики sums - ratio * counts, делённая на mean(counts) ** 2,
+    так что var / count - оценка дисперсии ratio, как для обычного среднего.
+
+    sums - np.array, суммы метрики по пользователям
+    counts - np.array or None, кол-во событий по пользователям (знаменатель ratio-метрики)
+    n_iter - int, кол-во итераций бутстрапа
+    block_size - int or None, кол-во итераций в одном блоке. Если None, то подбирается так,
+        чтобы в блоке было не больше 10 млн элементов.
+    seed - int, None or np.random.SeedSequence, состояние генератора случайных чисел
+
+    return - (mean, var, count), np.array длины n_iter, count - кол-во пользователей в выборке
+    """
+    sums = np.asarray(sums, dtype=float).ravel()
+    # центрируем агрегаты, чтобы не терять точность при вычитании квадратов
+    sums_shift = sums.mean()
+    sums_centered = sums - sums_shift
+    if counts is None:
+        aggregates = np.column_stack([np.ones(len(sums)), sums_centered, sums_centered ** 2])
+    else:
+        counts = np.asarray(counts, dtype=float).ravel()
+        counts_shift = counts.mean()
+        counts_centered = counts - counts_shift
+        aggregates = np.column_stack([
+            np.ones(len(sums)), sums_centered, sums_centered ** 2,
+            counts_centered, counts_centered ** 2, sums_centered * counts_centered
+        ])
+
+    res = []
+    for weights in generate_bootstrap_samples(len(sums), n_iter, block_size, 'poisson', seed):
+        res.append(_weighted_sums(weights, aggregates))
+    totals = np.vstack(res)
+
+    n = totals[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_s = totals[:, 1] / n
+        var_s = (totals[:, 2] - n * mean_s ** 2) / (n - 1)
+        if counts is None:
+            return mean_s + sums_shift, var_s, n
+        mean_c = totals[:, 3] / n
+        var_c = (totals[:, 4] - n * mean_c ** 2) / (n - 1)
+        cov_sc = (totals[:, 5] - n * mean_s * mean_c) / (n - 1)
+        mean_s += sums_shift
+        mean_c += counts_shift
+        ratio = mean_s / mean_c
+        var_linearized = var_s - 2 * ratio * cov_sc + ratio ** 2 * var_c
+    return ratio, var_linearized / mean_c ** 2, n
+
+
+def calculate_split_moments(values, indexes, chunk_size=100):
+    """Вычисляет моменты метрики для набора выборок, заданных матрицей индексов.
+
+    values - np.array, значения метрики
+    indexes - np.array формы (n_splits, size), индексы элементов values в каждой выборке,
+        например из stratification.select_stratified_indexes
+    chunk_size - int, кол-во выборок, обрабатываемых за раз
+
+    return - (mean, var), np.array длины n_splits со средними и несмещёнными дисперсиями
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    mean, var = [], []
+    for begin in range(0, len(indexes), chunk_size):
+        sample_values = values[indexes[begin:begin + chunk_size]]
+        mean.append(sample_values.mean(axis=1))
+        var.append(sample_values.var(axis=1, ddof=1))
+    return np.concatenate(mean), np.concatenate(var)
+
+
+def ttest_from_moments(mean_a, var_a, n_a, mean_b, var_b, n_b, equal_var=True):
+    """Вычисляет t-тест Стьюдента (или Уэлча) сразу для массива пар выборок по их моментам.
+
+    Результат совпадает с scipy.stats.ttest_ind(a, b, equal_var=equal_var) для каждой пары.
+
+    mean_a, var_a - np.array, средние и несмещённые дисперсии первых выборок
+    n_a - int or np.array, размеры первых выборок
+    mean_b, var_b - np.array, средние и несмещённые дисперсии вторых выборок
+    n_b - int or np.array, размеры вторых выборок
+    equal_var - bool, если True, то тест Стьюдента с общей дисперсией, иначе тест Уэлча
+
+    return - (statistic, pvalue), np.array значений статистики и p-value
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            df = n_a + n_b - 2
+            pooled_var = ((n_a - 1) * var_a + (n_b - 1) * var_b) / df
+            se2 = pooled_var * (1 / n_a + 1 / n_b)
+        else:
+            se2_a = var_a / n_a
+            se2_b = var_b / n_b
+            se2 = se2_a + se2_b
+            df = se2 ** 2 / (se2_a ** 2 / (n_a - 1) + se2_b ** 2 / (n_b - 1))
+        statistic = (mean_a - mean_b) / np.sqrt(se2)
+        pvalue = 2 * t_distribution.sf(np.abs(statistic), df)
+    return statistic, pvalue
+
+
+def ttest_from_standard_errors(mean_a, se2_a, mean_b, se2_b, df):
+    """Вычисляет t-тест для массива пар оценок средних по их дисперсиям.
+
+    Используется, когда дисперсия среднего считается не как var / n, например для
+    стратифицированного среднего.
+
+    mean_a, se2_a - np.array, оценки первых средних и их дисперсии
+    mean_b, se2_b - np.array, оценки вторых средних и их дисперсии
+    df - int or np.array, число степеней свободы
+
+    return - (statistic, pvalue), np.array значений статистики и p-value
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = (mean_a - mean_b) / np.sqrt(se2_a + se2_b)
+        pvalue = 2 * t_distribution.sf(np.abs(statistic), df)
+    return statistic, pvalue
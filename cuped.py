@@ -1,6 +1,72 @@
 import numpy as np
 import pandas as pd
 
+from daily_store import DailyAggregateStore
+from profiling import stage
+
+
+def calculate_period_metrics(
+    df, value_name, user_id_name, list_user_id, date_name, periods, with_count=False
+):
+    """
+    Вычисляет суммы метрики по пользователям сразу для нескольких периодов за один проход по данным.
+
+    Строки датафрейма один раз раскладываются по целочисленным кодам пользователя и периода,
+    после чего суммы для всех пар (пользователь, период) считаются одной группировкой (np.bincount).
+
+    df - pd.DataFrame, датафрейм с данными
+    value_name - str, название столбца со значениями для вычисления целевой метрики
+    user_id_name - str, название столбца с идентификаторами пользователей
+    list_user_id - List[int], список идентификаторов пользователей, для которых нужно посчитать метрики
+    date_name - str, название столбца с датами
+    periods - dict, словарь {название периода: {'begin': ..., 'end': ...}}. Периоды не должны пересекаться.
+        Пример, {
+            'prepilot': {'begin': '2020-01-01', 'end': '2020-01-08'},
+            'pilot': {'begin': '2020-01-08', 'end': '2020-01-15'}
+        }.
+    with_count - bool, если True, то дополнительно вычисляет кол-во значений f'{period_name}_count'
+
+    return - pd.DataFrame, со столбцами [user_id_name, *periods] (и f'{period_name}_count', если with_count),
+        кол-во строк равно кол-ву элементов в списке list_user_id.
+    """
+    period_names = sorted(periods, key=lambda name: periods[name]['begin'])
+    edges = []
+    for name in period_names:
+        if edges and periods[name]['begin'] < edges[-1]:
+            raise ValueError(f'Period "{name}" overlaps with another period.')
+        edges += [periods[name]['begin'], periods[name]['end']]
+
+    with stage('filter'):
+        users = pd.Index(list_user_id).unique()
+        user_codes = users.get_indexer(df[user_id_name])
+        dates = df[date_name].to_numpy()
+        # дата попадает в период с номером i, если begin_i <= date < end_i, то есть позиция нечётная,
+        # строки без даты получают позицию 0 и не попадают ни в один период
+        has_date = df[date_name].notna().to_numpy()
+        edge_positions = np.zeros(len(dates), dtype=int)
+        edge_positions[has_date] = np.searchsorted(
+            np.array(edges, dtype=dates.dtype), dates[has_date], side='right'
+        )
+        values = df[value_name].to_numpy(dtype=float)
+        mask = (user_codes >= 0) & (edge_positions % 2 == 1) & ~np.isnan(values)
+
+    with stage('groupby'):
+        n_cells = len(users) * len(period_names)
+        codes = user_codes[mask] * len(period_names) + edge_positions[mask] // 2
+        sums = np.bincount(codes, weights=values[mask], minlength=n_cells).reshape(len(users), -1)
+        if with_count:
+            counts = np.bincount(codes, minlength=n_cells).reshape(len(users), -1)
+
+    with stage('merge'):
+        rows = users.get_indexer(list_user_id)
+        res = pd.DataFrame({user_id_name: list_user_id})
+        for name in periods:
+            res[name] = sums[rows, period_names.index(name)]
+        if with_count:
+            for name in periods:
+                res[f'{name}_count'] = counts[rows, period_names.index(name)]
+    return res
+
 
 def calculate_metric(
     df, value_name, user_id_name, list_user_id, date_name, period, metric_name
@@ -8,7 +74,8 @@ def calculate_metric(
     """
     Вычисляет значение метрики для списка пользователей в определённый период.
     
-    df - pd.DataFrame, датафрейм с данными
+    df - pd.DataFrame or DailyAggregateStore, датафрейм с данными или хранилище поюзерных агрегатов
+        по дням (тогда value_name и date_name не используются)
     value_name - str, название столбца со значениями для вычисления целевой метрики
     user_id_name - str, название столбца с идентификаторами пользователей
     list_user_id - List[int], список идентификаторов пользователей, для которых нужно посчитать метрики
@@ -22,20 +89,27 @@ def calculate_metric(
         кол-ву элементов в списке list_user_id.
     """
     # YOUR_CODE_HERE
-    start_date = period['begin']
-    end_date = period['end']
-    
-    df_user_filter = df[df[user_id_name].isin(list_user_id)]
-    
-    df_date_filter = df_user_filter[
-        (df_user_filter[date_name] >= start_date) & (df_user_filter[date_name] < end_date)
-        ]
-    
-    purchase_by_user = df_date_filter.groupby(user_id_name).agg({value_name: 'sum'}).rename(columns={value_name: metric_name}).reset_index()
-    all_users_purchases = pd.DataFrame(data=list_user_id, columns=[user_id_name])
-    res = pd.merge(all_users_purchases, purchase_by_user, how='left', on=user_id_name).fillna(0)
+    if isinstance(df, DailyAggregateStore):
+        res = df.get_user_aggregates(list_user_id, period, user_id_name)
+        return res[[user_id_name, 'sum']].rename(columns={'sum': metric_name})
+    res = calculate_period_metrics(
+        df, value_name, user_id_name, list_user_id, date_name, {metric_name: period}
+    )
     return res
 
+def calculate_theta(y_prepilot_cov, y_pilot) -> float:
+    """
+    Вычисляем Theta.
+    
+    y_prepilot_cov - значения ковариаты (той же самой метрики, но на препилоте)
+    y_pilot - значения метрики во время пилота
+    """
+    covariance = np.cov(y_prepilot_cov, y_pilot)[0, 1]
+    variance = np.var(y_prepilot_cov)
+    theta = covariance / variance
+    return theta
+
+
 def calculate_metric_cuped(
     df, value_name, user_id_name, list_user_id, date_name, periods, metric_name
 ):
@@ -60,32 +134,90 @@ def calculate_metric_cuped(
         [user_id_name, metric_name, f'{metric_name}_prepilot', f'{metric_name}_cuped'],
         кол-во строк должно быть равно кол-ву элементов в списке list_user_id.
     """
-    prepilot_period = periods['prepilot']    
-    pilot_period = periods['pilot']
+    period_df = calculate_period_metrics(df, value_name, user_id_name, list_user_id, date_name, periods)
     
-    prepilot_df = calculate_metric(df, value_name, user_id_name, list_user_id, date_name, prepilot_period, metric_name)
-    pilot_df = calculate_metric(df, value_name, user_id_name, list_user_id, date_name, pilot_period, metric_name)    
-    
-    def calculate_theta(y_prepilot_cov, y_pilot) -> float:
-        """
-        Вычисляем Theta.
-        
-        y_control - значения метрики во время пилота на контрольной группе
-        y_pilot - значения метрики во время пилота на пилотной группе
-        y_control_cov - значения ковариант на контрольной группе (той же самой метрики, но на препилоте)
-        y_pilot_cov - значения ковариант на пилотной группе
-        """
-        #y = np.hstack([y_control, y_pilot])
-        #y_cov = np.hstack([y_control_cov, y_pilot_cov])
-        covariance = np.cov(y_prepilot_cov, y_pilot)[0, 1]
-        variance = np.var(y_prepilot_cov)
-        theta = covariance / variance
-        return theta
-    
-    theta = calculate_theta(prepilot_df[metric_name], pilot_df[metric_name])
-    #res = pd.concat([pilot_df, prepilot_df], axis=1)
-    res = pd.merge(pilot_df, prepilot_df, how='inner', on=user_id_name)
+    theta = calculate_theta(period_df['prepilot'], period_df['pilot'])
+    res = period_df[[user_id_name, 'pilot', 'prepilot']].copy()
     res.columns = [user_id_name, metric_name, f'{metric_name}_prepilot']
     res[f'{metric_name}_cuped'] = res[metric_name] - theta * res[f'{metric_name}_prepilot']
     
-    return res
\ No newline at end of file
+    return res
+
+def calculate_theta_multi(chunks):
+    """
+    Вычисляет вектор Theta для нескольких ковариат по блокам данных.
+
+    По блокам накапливаются достаточные статистики X'X и X'y (с добавленным свободным членом),
+    после чего решается система нормальных уравнений. Полная матрица ковариат не строится.
+
+    chunks - iterable of (np.array, np.array), пары (значения ковариат формы (size, k), значения метрики
+        во время пилота формы (size,))
+
+    return - np.array длины k, коэффициенты Theta для ковариат
+    """
+    xtx = None
+    xty = None
+    for x, y in chunks:
+        x = np.column_stack([np.ones(len(x)), x])
+        if xtx is None:
+            xtx = np.zeros((x.shape[1], x.shape[1]))
+            xty = np.zeros(x.shape[1])
+        xtx += x.T @ x
+        xty += x.T @ y
+    if xtx is None:
+        raise ValueError('No data to calculate theta.')
+    coef = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+    return coef[1:]
+
+
+def calculate_metric_cuped_multi(
+    df, value_name, user_id_name, list_user_id, date_name, periods, metric_name,
+    use_counts=True, predictions=None
+):
+    """
+    Вычисляет метрику во время пилота, ковариаты и преобразованную метрику cuped с несколькими ковариатами.
+
+    Ковариаты: значения метрики во всех периодах, кроме пилота, кол-во событий в этих периодах
+    и внешние предсказания метрики (CUPAC). Результат содержит ковариаты всех пользователей,
+    поэтому Theta считается по ним одним блоком. Для данных, которые не помещаются в память,
+    calculate_theta_multi можно передать блоки напрямую.
+
+    df - pd.DataFrame, датафрейм с данными
+    value_name - str, название столбца со значениями для вычисления целевой метрики
+    user_id_name - str, название столбца с идентификаторами пользователей
+    list_user_id - List[int], список идентификаторов пользователей, для которых нужно посчитать метрики
+    date_name - str, название столбца с датами
+    periods - dict, словарь с датами начала и конца периода пилота и любого кол-ва предыдущих периодов.
+        Пример, {
+            'prepilot_2': {'begin': '2019-12-25', 'end': '2020-01-01'},
+            'prepilot': {'begin': '2020-01-01', 'end': '2020-01-08'},
+            'pilot': {'begin': '2020-01-08', 'end': '2020-01-15'}
+        }.
+    metric_name - str, название полученной метрики
+    use_counts - bool, если True, то кол-во событий в предыдущих периодах тоже используется как ковариата
+    predictions - pd.DataFrame or None, внешние предсказания метрики, столбцы [user_id_name, ...].
+        Все столбцы, кроме user_id_name, используются как ковариаты, пропуски заполняются нулями.
+
+    return - pd.DataFrame, со столбцами
+        [user_id_name, metric_name, *ковариаты, f'{metric_name}_cuped'], где ковариаты называются
+        f'{metric_name}_{period}', f'{metric_name}_{period}_count' и как столбцы predictions,
+        кол-во строк равно кол-ву элементов в списке list_user_id.
+    """
+    period_df = calculate_period_metrics(
+        df, value_name, user_id_name, list_user_id, date_name, periods, with_count=use_counts
+    )
+    res = period_df[[user_id_name, 'pilot']].rename(columns={'pilot': metric_name})
+    for period_name in periods:
+        if period_name == 'pilot':
+            continue
+        res[f'{metric_name}_{period_name}'] = period_df[period_name]
+        if use_counts:
+            res[f'{metric_name}_{period_name}_count'] = period_df[f'{period_name}_count']
+    if predictions is not None:
+        res = pd.merge(res, predictions, how='left', on=user_id_name).fillna(0)
+    covariates = res[list(res.columns[2:])].to_numpy(dtype=float)
+    values = res[metric_name].to_numpy(dtype=float)
+
+    theta = calculate_theta_multi([(covariates, values)])
+    res[f'{metric_name}_cuped'] = values - covariates @ theta
+    return res
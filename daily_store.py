@@ -0,0 +1,245 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class DailyAggregateStore:
+    def __init__(self, path, prefix_sums=True, checkpoint_every=30):
+        """Создаём хранилище агрегатов метрики по дням на диске.
+
+        Для каждого дня в meta.json хранятся итоги (sum, count, n_users), их читает get_daily_aggregates.
+
+        Если prefix_sums=True, то хранилище отвечает и на запросы по пользователям (get_user_aggregates):
+            - для каждого дня в папке day=YYYY-MM-DD хранятся разреженные столбцы
+              (user_code, sum, count, sum_sq) только по пользователям с событиями в этот день;
+            - раз в checkpoint_every дней в папке дня дополнительно сохраняются плотные
+              префиксные суммы cum_sum, cum_count, cum_sum_sq по всем пользователям за все дни
+              до этого дня включительно.
+        Сумма за период [begin, end) - это разность двух префиксных сумм, каждая из которых
+        собирается из ближайшей контрольной точки и не больше checkpoint_every - 1 разреженных дней,
+        либо прямая сумма разреженных дней, если период короткий. Столбцы читаются через
+        np.load(mmap_mode='r'), исходные события не читаются.
+
+        Размер на диске: разреженные дни занимают ~ 28 байт на пару (пользователь, день с событиями),
+        контрольные точки - 24 байта на каждого пользователя раз в checkpoint_every дней,
+        то есть для 10 млн пользователей и checkpoint_every=30 примерно 8 ГБ за год.
+        Для ключей, которые каждый день новые (например, идентификаторов покупок для
+        calculate_sales_metrics), нужно создавать хранилище с prefix_sums=False,
+        тогда по дням хранятся только итоги.
+
+        Дни добавляются только по возрастанию, уже записанные дни не меняются.
+        meta.json записывается последним, поэтому прерванный append не виден при следующем открытии.
+
+        :param path: str, путь к папке хранилища.
+        :param prefix_sums: bool, хранить ли агрегаты по пользователям для get_user_aggregates.
+        :param checkpoint_every: int, раз во сколько дней сохранять плотные префиксные суммы.
+            Для уже существующего хранилища prefix_sums и checkpoint_every берутся из meta.json.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.days = meta['days']
+            self.totals = meta['totals']
+            self.prefix_sums = meta['prefix_sums']
+            self.checkpoint_every = meta['checkpoint_every']
+        else:
+            self.days = []
+            self.totals = {'sum': [], 'count': [], 'n_users': []}
+            self.prefix_sums = prefix_sums
+            self.checkpoint_every = checkpoint_every
+        user_ids_path = os.path.join(path, 'user_ids.npy')
+        if self.prefix_sums and os.path.exists(user_ids_path):
+            self.user_ids = np.load(user_ids_path, allow_pickle=True)
+        else:
+            self.user_ids = np.array([], dtype=np.int64)
+        self._user_index = pd.Index(self.user_ids)
+
+    def _day_path(self, day):
+        return os.path.join(self.path, f'day={day}')
+
+    def _load(self, day, name):
+        return np.load(os.path.join(self._day_path(day), f'{name}.npy'), mmap_mode='r')
+
+    def _is_checkpoint(self, day_number):
+        """Хранит ли день с номером day_number плотные префиксные суммы."""
+        return (day_number + 1) % self.checkpoint_every == 0
+
+    def _get_last_checkpoint(self, day_end):
+        """Номер последнего дня с префиксными суммами среди дней [0, day_end), -1 если такого нет."""
+        return day_end // self.checkpoint_every * self.checkpoint_every - 1
+
+    def _sum_days(self, codes, day_begin, day_end):
+        """Суммы (sum, count, sum_sq) по разреженным дням [day_begin, day_end) для кодов пользователей codes."""
+        res = {name: np.zeros(len(codes)) for name in ('sum', 'count', 'sum_sq')}
+        for day in self.days[day_begin:day_end]:
+            day_codes = self._load(day, 'user_code')
+            if len(day_codes) == 0:
+                continue
+            # коды в дне отсортированы по возрастанию
+            positions = np.minimum(np.searchsorted(day_codes, codes), len(day_codes) - 1)
+            found = day_codes[positions] == codes
+            for name in res:
+                res[name][found] += self._load(day, name)[positions[found]]
+        return res
+
+    def _get_prefix(self, codes, day_end):
+        """Суммы (sum, count, sum_sq) за дни [0, day_end) для кодов пользователей codes."""
+        checkpoint = self._get_last_checkpoint(day_end)
+        res = self._sum_days(codes, checkpoint + 1, day_end)
+        if checkpoint >= 0:
+            for name in res:
+                cum = self._load(self.days[checkpoint], f'cum_{name}')
+                known = (codes >= 0) & (codes < len(cum))
+                res[name][known] += cum[codes[known]]
+        return res
+
+    def _save_atomic(self, file_name, save):
+        """Записывает файл во временный и подменяет им старый одной операцией os.replace."""
+        tmp_path = os.path.join(self.path, f'{file_name}.tmp')
+        with open(tmp_path, 'wb') as f:
+            save(f)
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+
+    def append(self, df, value_name, user_id_name, date_name):
+        """
+        Добавляет события за новые дни.
+
+        :param df: pd.DataFrame, события за дни позже последнего записанного дня.
+        :param value_name: str, название столбца со значениями метрики.
+        :param user_id_name: str, название столбца с идентификаторами пользователей
+            (или покупок, если хранилище используется для calculate_sales_metrics).
+        :param date_name: str, название столбца с датами. Строки без даты пропускаются.
+        """
+        df = df[df[date_name].notna()]
+        days = pd.to_datetime(df[date_name]).dt.strftime('%Y-%m-%d').to_numpy()
+        new_days = sorted(set(days))
+        if self.days and new_days and new_days[0] <= self.days[-1]:
+            raise ValueError(f'Day {new_days[0]} is not later than the last stored day {self.days[-1]}.')
+
+        if self.prefix_sums:
+            new_users = pd.Index(df[user_id_name].unique()).difference(self._user_index).to_numpy()
+            user_ids = np.concatenate([self.user_ids, new_users]) if len(self.user_ids) else new_users
+            user_index = pd.Index(user_ids)
+        else:
+            # ключи нужны только внутри дня, поэтому кодируем их заново и не сохраняем
+            user_index = pd.Index(df[user_id_name].unique())
+        n_users = len(user_index)
+        user_codes = user_index.get_indexer(df[user_id_name])
+        values = df[value_name].to_numpy(dtype=float)
+
+        # плотные суммы с начала хранилища нужны, только если в этом батче есть контрольная точка
+        cum = None
+        has_checkpoint = any(self._is_checkpoint(len(self.days) + k) for k in range(len(new_days)))
+        if self.prefix_sums and has_checkpoint:
+            prefix = self._get_prefix(np.arange(len(self.user_ids)), len(self.days))
+            cum = {name: np.zeros(n_users) for name in prefix}
+            for name in prefix:
+                cum[name][:len(self.user_ids)] = prefix[name]
+
+        order = np.argsort(days, kind='stable')
+        day_starts = np.searchsorted(days[order], new_days)
+        day_ends = np.searchsorted(days[order], new_days, side='right')
+        totals = {name: [] for name in self.totals}
+        for day_number, (day, begin, end) in enumerate(zip(new_days, day_starts, day_ends), len(self.days)):
+            rows = order[begin:end]
+            rows = rows[~np.isnan(values[rows])]
+            day_sum = np.bincount(user_codes[rows], weights=values[rows], minlength=n_users)
+            day_count = np.bincount(user_codes[rows], minlength=n_users).astype(float)
+            totals['sum'].append(float(day_sum.sum()))
+            totals['count'].append(float(day_count.sum()))
+            totals['n_users'].append(int(np.count_nonzero(day_count)))
+            if not self.prefix_sums:
+                continue
+
+            day_sum_sq = np.bincount(user_codes[rows], weights=values[rows] ** 2, minlength=n_users)
+            active = np.flatnonzero(day_count)
+            columns = {
+                'user_code': active.astype(np.int32 if n_users < 2 ** 31 else np.int64),
+                'sum': day_sum[active],
+                'count': day_count[active],
+                'sum_sq': day_sum_sq[active],
+            }
+            if cum is not None:
+                cum['sum'] += day_sum
+                cum['count'] += day_count
+                cum['sum_sq'] += day_sum_sq
+                if self._is_checkpoint(day_number):
+                    columns.update({f'cum_{name}': column for name, column in cum.items()})
+
+            os.makedirs(self._day_path(day), exist_ok=True)
+            for name, column in columns.items():
+                np.save(os.path.join(self._day_path(day), f'{name}.npy'), column)
+
+        if self.prefix_sums:
+            self._save_atomic('user_ids.npy', lambda f: np.save(f, user_ids, allow_pickle=True))
+        meta = {
+            'days': self.days + new_days,
+            'totals': {name: self.totals[name] + totals[name] for name in self.totals},
+            'prefix_sums': self.prefix_sums,
+            'checkpoint_every': self.checkpoint_every,
+        }
+        self._save_atomic('meta.json', lambda f: f.write(json.dumps(meta).encode()))
+
+        self.days, self.totals = meta['days'], meta['totals']
+        if self.prefix_sums:
+            self.user_ids, self._user_index = user_ids, user_index
+
+    def _get_day_range(self, period):
+        """Номера первого и следующего за последним записанных дней, попадающих в период."""
+        begin = pd.Timestamp(period['begin']).strftime('%Y-%m-%d')
+        end = pd.Timestamp(period['end']).strftime('%Y-%m-%d')
+        return np.searchsorted(self.days, begin), np.searchsorted(self.days, end)
+
+    def get_user_aggregates(self, list_user_id, period, user_id_name='user_id'):
+        """
+        Вычисляет агрегаты метрики по пользователям за период.
+
+        Короткий период суммируется по разреженным дням напрямую, длинный - как разность
+        префиксных сумм, собранных от ближайших контрольных точек.
+
+        :param list_user_id: List, список идентификаторов пользователей.
+        :param period: dict, словарь с датами начала и конца периода {'begin': ..., 'end': ...},
+            дата начала входит в полуинтервал, а дата окончания нет.
+        :param user_id_name: str, название столбца с идентификаторами пользователей в результате.
+
+        :return pd.DataFrame со столбцами [user_id_name, 'sum', 'count', 'sum_sq'],
+            кол-во строк равно кол-ву элементов в списке list_user_id.
+        """
+        if not self.prefix_sums:
+            raise ValueError('User aggregates require a store created with prefix_sums=True.')
+        first_day, last_day = self._get_day_range(period)
+        codes = self._user_index.get_indexer(list_user_id)
+        if last_day - first_day <= 2 * self.checkpoint_every:
+            sums = self._sum_days(codes, first_day, last_day)
+        else:
+            sums = self._get_prefix(codes, last_day)
+            sums_begin = self._get_prefix(codes, first_day)
+            for name in sums:
+                sums[name] -= sums_begin[name]
+        res = pd.DataFrame({user_id_name: list_user_id})
+        for name in ('sum', 'count', 'sum_sq'):
+            res[name] = sums[name]
+        return res
+
+    def get_daily_aggregates(self, period):
+        """
+        Вычисляет агрегаты метрики по дням периода.
+
+        :param period: dict, словарь с датами начала и конца периода {'begin': ..., 'end': ...}.
+
+        :return pd.DataFrame, индекс - записанные дни периода (datetime64[ns]), столбцы
+            ['sum', 'count', 'n_users'], где n_users - кол-во пользователей с событиями в этот день.
+        """
+        first_day, last_day = self._get_day_range(period)
+        days = self.days[first_day:last_day]
+        res = pd.DataFrame(
+            {name: self.totals[name][first_day:last_day] for name in ('sum', 'count', 'n_users')},
+            index=pd.to_datetime(pd.Index(days, dtype=object)),
+        )
+        res[['sum', 'count']] = res[['sum', 'count']].astype(float)
+        return res
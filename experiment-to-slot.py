@@ -1,6 +1,71 @@
 import numpy as np
 import pandas as pd
 import hashlib
+from array import array
+from functools import lru_cache
+
+
+def get_hash_modulo(value: str, modulo: int, salt: str = '0'):
+    """Вычисляем остаток от деления: (hash(value) + salt) % modulo."""
+    hash_value = int(hashlib.md5(str.encode(str(value) + str(salt))).hexdigest(), 16)
+    return hash_value % modulo
+
+
+class RoutingTable:
+    """Неизменяемый снимок распределения экспериментов по слотам для онлайн-назначения пользователей.
+
+    Эксперименты слота хранятся в компактных массивах: slot_offsets и slot_experiment_codes,
+    эксперименты слота slot - это slot_experiment_codes[slot_offsets[slot]:slot_offsets[slot + 1]].
+    Соли экспериментов закодированы заранее, результаты для частых пользователей кешируются (LRU).
+    Снимок не меняется после создания, поэтому его можно читать из нескольких потоков,
+    а при изменении экспериментов заменять целиком на новый.
+    """
+
+    def __init__(self, slot_to_experiments, salt_one, salt_two, cache_size=100000):
+        """
+        slot_to_experiments - dict, {слот: список идентификаторов экспериментов}
+        salt_one - соль для определения слота пользователя
+        salt_two - соль для определения группы пользователя в эксперименте
+        cache_size - int or None, размер LRU кеша для пользователей, как maxsize в functools.lru_cache:
+            None - кеш без ограничения размера, 0 - без кеша.
+        """
+        self.count_slots = len(slot_to_experiments)
+        self.experiment_ids = tuple(sorted({
+            exp for exps in slot_to_experiments.values() for exp in exps
+        }))
+        exp_codes = {exp: code for code, exp in enumerate(self.experiment_ids)}
+
+        self.slot_offsets = array('I', [0])
+        self.slot_experiment_codes = array('I')
+        for slot in range(self.count_slots):
+            self.slot_experiment_codes.extend(exp_codes[exp] for exp in slot_to_experiments[slot])
+            self.slot_offsets.append(len(self.slot_experiment_codes))
+
+        self._salt_one = str.encode(str(salt_one))
+        self._exp_suffixes = tuple(str.encode(exp + str(salt_two)) for exp in self.experiment_ids)
+        self.assign = self._assign if cache_size == 0 else lru_cache(maxsize=cache_size)(self._assign)
+
+    def _assign(self, user_id):
+        """
+        Определяет в какие эксперименты попадает пользователь, результат совпадает с ABSplitter.process_user.
+
+        user_id - идентификатор пользователя.
+
+        return - (int, tuple), слот и кортеж пар (experiment_id, pilot/control group).
+        """
+        user_hash = hashlib.md5(str.encode(str(user_id)))
+        slot_hash = user_hash.copy()
+        slot_hash.update(self._salt_one)
+        user_slot = int.from_bytes(slot_hash.digest(), 'big') % self.count_slots
+
+        exp_and_group = []
+        codes = self.slot_experiment_codes[self.slot_offsets[user_slot]:self.slot_offsets[user_slot + 1]]
+        for code in codes:
+            group_hash = user_hash.copy()
+            group_hash.update(self._exp_suffixes[code])
+            group_name = 'pilot' if group_hash.digest()[-1] & 1 else 'control'
+            exp_and_group.append((self.experiment_ids[code], group_name))
+        return (user_slot, tuple(exp_and_group))
 
 
 class ABSplitter:
@@ -12,7 +77,41 @@ class ABSplitter:
         self.slots = np.arange(count_slots)
         self.experiments = []
         self.experiment_to_slots = dict()
-        self.slot_to_experiments = dict()
+        self.routing_table = None
+        self._reset_slots()
+
+    def _reset_slots(self):
+        """Освобождает все слоты.
+
+        Занятость хранится в матрице self.slot_occupancy (строка - маска слотов эксперимента).
+        Приоритет слотов по загрузке хранится в массиве self.slot_order, отсортированном по убыванию
+        self.slot_load: слоты с загрузкой load лежат на позициях
+        [self.load_starts[load], self.load_starts[load - 1]) (для load = 0 - до конца массива).
+        Внутри одной загрузки слоты идут в случайном порядке. Порядок выбирается при первом
+        размещении (_place_experiments), поэтому создание сплиттера не тратит состояние np.random.
+        """
+        self.slot_to_experiments = {slot: [] for slot in self.slots}
+        self.experiment_codes = {}
+        self.slot_occupancy = np.zeros((0, len(self.slots)), dtype=bool)
+        self.slot_load = np.zeros(len(self.slots), dtype=int)
+        self.slot_order = None
+        self.slot_positions = None
+        self.load_starts = [0]
+        self.overweight_experiments = []
+
+    def _increase_slot_load(self, slot):
+        """Увеличивает загрузку слота на 1, перемещая его в соседнюю группу self.slot_order одним обменом."""
+        load = self.slot_load[slot]
+        if load + 1 == len(self.load_starts):
+            self.load_starts.append(self.load_starts[load])
+        # меняем слот местами с первым слотом своей группы и сдвигаем границу групп
+        first = self.load_starts[load]
+        position = self.slot_positions[slot]
+        first_slot = self.slot_order[first]
+        self.slot_order[first], self.slot_order[position] = slot, first_slot
+        self.slot_positions[slot], self.slot_positions[first_slot] = first, position
+        self.load_starts[load] = first + 1
+        self.slot_load[slot] = load + 1
 
     def split_experiments(self, experiments):
         """
@@ -32,40 +131,94 @@ class ABSplitter:
             Возвращает пустой список, если всем экспериментам хватило слотов.
         """
         self.experiments = sorted(experiments, key=lambda x: len(x['conflict_experiments']), reverse=True)
-        self.slot_to_experiments = {slot: [] for slot in self.slots}
         self.experiment_to_slots = {pilot['experiment_id']: [] for pilot in self.experiments}
+        self._reset_slots()
+        self.slot_occupancy = np.zeros((len(self.experiments), len(self.slots)), dtype=bool)
         
-        self.overweight_experiments = []
-        for exp in self.experiments:
+        self.overweight_experiments = self._place_experiments(self.experiments)
+        
+        # новый снимок подменяется одним присваиванием, читатели продолжают работать со старым
+        self.routing_table = RoutingTable(self.slot_to_experiments, self.salt_one, self.salt_two)
+        return self.overweight_experiments
+
+    def add_experiments(self, experiments):
+        """
+        Добавляет новые эксперименты к уже распределённым, не перемещая запущенные эксперименты.
+
+        experiments - список словарей, описывающих пилот, в том же формате, что и в split_experiments.
+            Идентификаторы должны быть новыми: изменить уже добавленный эксперимент можно только
+            через split_experiments.
+        return: List[dict], список новых экспериментов, которые не удалось разместить по слотам.
+        """
+        new_ids = [pilot['experiment_id'] for pilot in experiments]
+        known_ids = set(self.experiment_to_slots) & set(new_ids)
+        if known_ids or len(set(new_ids)) != len(new_ids):
+            raise ValueError(f'Experiments are already added or duplicated: {sorted(known_ids) or new_ids}.')
+        experiments = sorted(experiments, key=lambda x: len(x['conflict_experiments']), reverse=True)
+        self.experiments = self.experiments + experiments
+        for pilot in experiments:
+            self.experiment_to_slots[pilot['experiment_id']] = []
+        self.slot_occupancy = np.vstack([
+            self.slot_occupancy, np.zeros((len(experiments), len(self.slots)), dtype=bool)
+        ])
+        
+        overweight_experiments = self._place_experiments(experiments)
+        self.overweight_experiments = self.overweight_experiments + overweight_experiments
+        
+        self.routing_table = RoutingTable(self.slot_to_experiments, self.salt_one, self.salt_two)
+        return overweight_experiments
+
+    def _place_experiments(self, experiments):
+        """
+        Размещает эксперименты по слотам с учётом уже размещённых.
+
+        Несовместные слоты находятся одной операцией по строкам матрицы self.slot_occupancy,
+        слоты выбираются по убыванию загрузки: первые доступные в порядке self.slot_order,
+        после размещения порядок обновляется обменами, без сортировки.
+        Учитываются конфликты в обе стороны: и из списка эксперимента, и из списков других экспериментов.
+
+        return: List[dict], список экспериментов, которые не удалось разместить по слотам.
+        """
+        if self.slot_order is None:
+            self.slot_order = np.random.permutation(len(self.slots))
+            self.slot_positions = np.argsort(self.slot_order)
+
+        reverse_conflicts = {}
+        for pilot in self.experiments:
+            for conflict_pilot_id in pilot['conflict_experiments']:
+                reverse_conflicts.setdefault(conflict_pilot_id, []).append(pilot['experiment_id'])
+        
+        overweight_experiments = []
+        for exp in experiments:
             if exp['count_slots'] > len(self.slots):
-                #print(f'ERROR: experiment_id={exp["experiment_id"]} needs too many slots.')
-                self.overweight_experiments.append(exp)
+                overweight_experiments.append(exp)
                 continue
             
             # найдём доступные слоты
-            notavailable_slots = []
-            for conflict_pilot_id in exp['conflict_experiments']:
-                notavailable_slots += self.experiment_to_slots[conflict_pilot_id]
-            available_slots = list(set(self.slots) - set(notavailable_slots))
+            conflict_codes = [
+                self.experiment_codes[conflict_pilot_id]
+                for conflict_pilot_id in set(exp['conflict_experiments'])
+                | set(reverse_conflicts.get(exp['experiment_id'], []))
+                if conflict_pilot_id in self.experiment_codes
+            ]
+            notavailable_slots = self.slot_occupancy[conflict_codes].any(axis=0)
+            available_positions = np.flatnonzero(~notavailable_slots[self.slot_order])
             
-            if exp['count_slots'] > len(available_slots):
-                #print(f'ERROR: experiment_id="{exp["experiment_id"]}" not enough available slots.')
-                self.overweight_experiments.append(exp)
+            if exp['count_slots'] > len(available_positions):
+                overweight_experiments.append(exp)
                 continue
             
-            np.random.shuffle(available_slots)
-            available_slots_orderby_count_pilot = sorted(
-                available_slots,
-                key=lambda x: len(self.slot_to_experiments[x]), reverse=True
-            )
-            
-            pilot_slots = available_slots_orderby_count_pilot[:exp['count_slots']]
-            self.experiment_to_slots[exp['experiment_id']] = list(pilot_slots) 
+            pilot_slots = self.slot_order[available_positions[:exp['count_slots']]]
             
+            code = len(self.experiment_codes)
+            self.experiment_codes[exp['experiment_id']] = code
+            self.slot_occupancy[code, pilot_slots] = True
+            for slot in pilot_slots:
+                self._increase_slot_load(slot)
+            self.experiment_to_slots[exp['experiment_id']] = list(pilot_slots)
             for slot in pilot_slots:
                 self.slot_to_experiments[slot].append(exp['experiment_id'])
-            
-        return self.overweight_experiments
+        return overweight_experiments
         
     def process_user(self, user_id: str):
         """
@@ -82,11 +235,6 @@ class ABSplitter:
         slot_modulo = len(self.slot_to_experiments)
         group_modulo = 2 #(0-pilot, 1-control)
         
-        def get_hash_modulo(value: str, modulo: int, salt: str = '0'):
-            """Вычисляем остаток от деления: (hash(value) + salt) % modulo."""
-            hash_value = int(hashlib.md5(str.encode(str(value) + str(salt))).hexdigest(), 16)
-            return hash_value % modulo
-        
         user_slot = get_hash_modulo(user_id, modulo=slot_modulo, salt=self.salt_one)
         exp_and_group = []
         for exp in self.slot_to_experiments[user_slot]:
@@ -96,4 +244,57 @@ class ABSplitter:
             else:
                 group_name = 'control'
             exp_and_group.append(tuple([exp, group_name]))
-        return (user_slot, exp_and_group)
\ No newline at end of file
+        return (user_slot, exp_and_group)
+
+    def assign_user(self, user_id):
+        """
+        Определяет в какие эксперименты попадает пользователь по текущему снимку RoutingTable.
+
+        user_id - идентификатор пользователя.
+
+        return - (int, tuple), слот и кортеж пар (experiment_id, pilot/control group).
+        """
+        return self.routing_table.assign(user_id)
+
+    def process_users(self, user_ids):
+        """
+        Определяет в какие эксперименты попадают пользователи, сразу для массива пользователей.
+
+        Результат совпадает с process_user для каждого пользователя. md5 от user_id считается
+        один раз, для слота и для каждого эксперимента копируется состояние хеша и дописывается
+        только суффикс. Остаток от деления на 2 берётся из последнего байта хеша.
+
+        Это не векторизованный расчёт: для совпадения с process_user бит в бит нужен md5
+        на каждого пользователя и каждый эксперимент его слота, поэтому остаётся цикл python,
+        и скорость ограничена md5 (примерно в 2-3 раза быстрее process_user).
+        Для больших пересчётов (сотни миллионов пользователей) user_ids нужно делить на части
+        и обрабатывать их в отдельных процессах, результаты частей независимы.
+
+        user_ids - iterable of str, идентификаторы пользователей.
+
+        return - (np.array, pd.DataFrame), слоты пользователей в порядке user_ids и датафрейм
+            со столбцами ['user_id', 'experiment_id', 'group'] c группами пользователей в экспериментах.
+        """
+        slot_modulo = len(self.slot_to_experiments)
+        salt_one = str.encode(str(self.salt_one))
+        exp_suffixes = {
+            exp: str.encode(exp + str(self.salt_two))
+            for exps in self.slot_to_experiments.values() for exp in exps
+        }
+
+        slots = []
+        users, exp_ids, groups = [], [], []
+        for user_id in user_ids:
+            user_hash = hashlib.md5(str.encode(str(user_id)))
+            slot_hash = user_hash.copy()
+            slot_hash.update(salt_one)
+            user_slot = int.from_bytes(slot_hash.digest(), 'big') % slot_modulo
+            slots.append(user_slot)
+            for exp in self.slot_to_experiments[user_slot]:
+                group_hash = user_hash.copy()
+                group_hash.update(exp_suffixes[exp])
+                users.append(user_id)
+                exp_ids.append(exp)
+                groups.append('pilot' if group_hash.digest()[-1] & 1 else 'control')
+        exp_and_group = pd.DataFrame({'user_id': users, 'experiment_id': exp_ids, 'group': groups})
+        return np.array(slots, dtype=int), exp_and_group
@@ -1,11 +1,23 @@
 import numpy as np
-import pandas as pd
-from scipy.stats import ttest_ind
 
-def estimate_first_type_error(df_pilot_group, df_control_group, metric_name, alpha=0.05, n_iter=10000, seed=None):
+from bootstrap import (
+    calculate_bootstrap_moments, calculate_bootstrap_moments_parallel,
+    calculate_poisson_bootstrap_moments, calculate_split_moments, ttest_from_moments,
+    ttest_from_standard_errors
+)
+from profiling import stage
+from stratification import calculate_stratified_moments, get_strata_weights
+
+
+def estimate_first_type_error(
+    df_pilot_group, df_control_group, metric_name, alpha=0.05, n_iter=10000, seed=None,
+    equal_var=True, chunk_size=1000, n_jobs=None, block_size=None, bootstrap_method='index'
+):
     """Оцениваем ошибку первого рода.
 
     Бутстрепим выборки из пилотной и контрольной групп тех же размеров, считаем долю случаев с значимыми отличиями.
+    Статистики t-теста считаются сразу для всех итераций по средним и дисперсиям бутстрепных выборок,
+    матрица бутстрепа генерируется блоками по chunk_size строк.
     
     df_pilot_group - pd.DataFrame, датафрейм с данными пилотной группы
     df_control_group - pd.DataFrame, датафрейм с данными контрольной группы
@@ -13,26 +25,116 @@ def estimate_first_type_error(df_pilot_group, df_control_group, metric_name, alp
     alpha - float, уровень значимости для статтеста
     n_iter - int, кол-во итераций бутстрапа
     seed - int or None, состояние генератора случайных чисел.
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    chunk_size - int, кол-во строк матрицы бутстрапа, которые генерируются за раз
+    n_jobs - int or None, кол-во процессов для бутстрапа. Если None, то бутстреп в одном процессе
+        с глобальным генератором np.random, как раньше. Иначе итерации делятся на блоки
+        с собственными генераторами из seed, результат не зависит от значения n_jobs.
+    block_size - int or None, кол-во итераций бутстрапа в одном блоке, если n_jobs не None.
+        Если None, то подбирается так, чтобы в блоке было не больше 10 млн элементов.
+    bootstrap_method - str, способ семплирования, если n_jobs не None: 'index' - индексы элементов,
+        'poisson' - веса пуассоновского бутстрапа
 
     return - float, ошибка первого рода
     """
-    np.random.seed(seed)
-    
-    
-    a_bootstrap = np.random.choice(
-        df_control_group.loc[:,metric_name].to_numpy().ravel(), 
-        size=(len(df_control_group), n_iter)
+    values_control = df_control_group.loc[:,metric_name].to_numpy().ravel()
+    values_pilot = df_pilot_group.loc[:,metric_name].to_numpy().ravel()
+    with stage('bootstrap'):
+        if n_jobs is None:
+            np.random.seed(seed)
+            a_mean, a_var = calculate_bootstrap_moments(values_control, n_iter, chunk_size)
+            b_mean, b_var = calculate_bootstrap_moments(values_pilot, n_iter, chunk_size)
+            a_count, b_count = len(values_control), len(values_pilot)
+        else:
+            a_mean, a_var, a_count, b_mean, b_var, b_count = calculate_bootstrap_moments_parallel(
+                values_control, values_pilot, n_iter, seed, n_jobs, block_size, bootstrap_method
+            )
+
+    with stage('test'):
+        _, pvalues = ttest_from_moments(
+            a_mean, a_var, a_count, b_mean, b_var, b_count, equal_var
         )
-    b_bootstrap = np.random.choice(
-        df_pilot_group.loc[:,metric_name].to_numpy().ravel(), 
-        size=(len(df_pilot_group), n_iter)
+    false_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки I рода
+    return np.mean(false_positive_tt)
+
+
+def estimate_first_type_error_poisson(
+    df_pilot_group, df_control_group, sum_name, count_name=None, alpha=0.05, n_iter=10000,
+    seed=None, equal_var=True, block_size=None
+):
+    """Оцениваем ошибку первого рода пуассоновским бутстрепом по поюзерным агрегатам.
+
+    Вместо ресемплинга сырых значений каждой итерации соответствует вектор весов Poisson(1),
+    суммы по группе считаются умножением матрицы весов на матрицу агрегатов.
+    Для ratio-метрики (задан count_name) дисперсия оценивается дельта-методом.
+
+    df_pilot_group - pd.DataFrame, датафрейм с агрегатами пилотной группы, одна строка - один пользователь
+    df_control_group - pd.DataFrame, датафрейм с агрегатами контрольной группы
+    sum_name - str, название столбца с суммой метрики по пользователю, например столбец периода
+        из cuped.calculate_period_metrics(..., with_count=True) или 'sum' из DailyAggregateStore.get_user_aggregates
+    count_name - str or None, название столбца с кол-вом событий по пользователю,
+        например f'{period_name}_count' или 'count' из тех же функций.
+        Если None, то метрика - среднее sum_name по пользователям.
+    alpha - float, уровень значимости для статтеста
+    n_iter - int, кол-во итераций бутстрапа
+    seed - int or None, состояние генератора случайных чисел
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    block_size - int or None, кол-во итераций бутстрапа в одном блоке.
+        Если None, то подбирается так, чтобы в блоке было не больше 10 млн элементов.
+
+    return - float, ошибка первого рода
+    """
+    seed_control, seed_pilot = np.random.SeedSequence(seed).spawn(2)
+    moments = []
+    for df, group_seed in ((df_control_group, seed_control), (df_pilot_group, seed_pilot)):
+        counts = None if count_name is None else df[count_name].to_numpy()
+        moments += calculate_poisson_bootstrap_moments(
+            df[sum_name].to_numpy(), counts, n_iter, block_size, group_seed
         )
-    
-    false_positive_tt = []
-    for i in range(n_iter):
-        a_sample = pd.DataFrame(a_bootstrap).loc[:,i]
-        b_sample = pd.DataFrame(b_bootstrap).loc[:,i]
-        pvalue_ab_tt = ttest_ind(a_sample, b_sample)[1]
-        false_positive_tt.append(int(pvalue_ab_tt < alpha)) # Фиксируем ошибки I рода
-    
-    return np.mean(false_positive_tt)
\ No newline at end of file
+
+    _, pvalues = ttest_from_moments(*moments, equal_var)
+    false_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки I рода
+    return np.mean(false_positive_tt)
+
+
+def estimate_first_type_error_by_splits(
+    df, metric_name, pilot_indexes, control_indexes, alpha=0.05, equal_var=True, chunk_size=100,
+    strat_columns=None, weights=None
+):
+    """Оцениваем ошибку первого рода по набору готовых разбиений на пилот и контроль (A/A тест).
+
+    df - pd.DataFrame, датафрейм с данными всех объектов
+    metric_name - str, названия столбца с метрикой
+    pilot_indexes - np.array формы (n_splits, size), позиционные индексы строк df в пилотных группах,
+        например из stratification.select_stratified_indexes
+    control_indexes - np.array формы (n_splits, size), позиционные индексы строк df в контрольных группах
+    alpha - float, уровень значимости для статтеста
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    chunk_size - int, кол-во разбиений, обрабатываемых за раз
+    strat_columns - List[str] or None, столбцы для стратификации. Если заданы, то вместо t-теста
+        по обычным средним используется тест по стратифицированным средним (постстратификация).
+    weights - dict, словарь весов страт, в том же формате, что и в select_stratified_groups.
+        Если None, веса пропорциональны долям страт в df.
+
+    return - float, ошибка первого рода
+    """
+    values = df[metric_name].to_numpy()
+    if strat_columns is None:
+        a_mean, a_var = calculate_split_moments(values, control_indexes, chunk_size)
+        b_mean, b_var = calculate_split_moments(values, pilot_indexes, chunk_size)
+        _, pvalues = ttest_from_moments(
+            a_mean, a_var, control_indexes.shape[1], b_mean, b_var, pilot_indexes.shape[1], equal_var
+        )
+    else:
+        strata_codes, strata_weights = get_strata_weights(df, strat_columns, weights)
+        a_mean, a_se2 = calculate_stratified_moments(
+            values, strata_codes, strata_weights, control_indexes, chunk_size
+        )
+        b_mean, b_se2 = calculate_stratified_moments(
+            values, strata_codes, strata_weights, pilot_indexes, chunk_size
+        )
+        _, pvalues = ttest_from_standard_errors(
+            a_mean, a_se2, b_mean, b_se2, control_indexes.shape[1] + pilot_indexes.shape[1] - 2
+        )
+    false_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки I рода
+    return np.mean(false_positive_tt)
@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 
+from daily_store import DailyAggregateStore
+from profiling import stage
+
 
 def calculate_linearized_metric(
     df, value_name, user_id_name, list_user_id, date_name, period, metric_name, kappa=None
@@ -8,7 +11,9 @@ def calculate_linearized_metric(
     """
     Вычисляет значение линеаризованной метрики для списка пользователей в определённый период.
     
-    df - pd.DataFrame, датафрейм с данными
+    df - pd.DataFrame or iterable of pd.DataFrame, датафрейм с данными или итератор по частям данных.
+        Суммы и кол-во значений по пользователям и kappa накапливаются по частям.
+        Также можно передать DailyAggregateStore, тогда value_name и date_name не используются.
     value_name - str, название столбца со значениями для вычисления целевой метрики
     user_id_name - str, название столбца с идентификаторами пользователей
     list_user_id - List[int], список идентификаторов пользователей, для которых нужно посчитать метрики
@@ -27,19 +32,37 @@ def calculate_linearized_metric(
     start_date = period['begin']
     end_date = period['end']
     
-    df_fil = df[
-        (df[date_name] >= start_date) 
-        & (df[date_name] < end_date)
-        & (df[user_id_name].isin(list_user_id))
-        ]
-    all_users = pd.DataFrame(data=list_user_id, columns=[user_id_name])
-    df_filtered = pd.merge(all_users, df_fil, how='left', on=user_id_name)
+    users = pd.Index(list_user_id).unique().sort_values()
+    if isinstance(df, DailyAggregateStore):
+        df_store = df.get_user_aggregates(users, period, user_id_name)
+        chunks = []
+        sums = df_store['sum'].to_numpy(dtype=float)
+        counts = df_store['count'].to_numpy(dtype=float)
+    else:
+        chunks = [df] if isinstance(df, pd.DataFrame) else df
+        # суммы копятся в массивах фиксированного размера по кодам пользователей, без выравнивания индексов
+        sums = np.zeros(len(users))
+        counts = np.zeros(len(users))
+    
+    for chunk in chunks:
+        with stage('filter'):
+            df_fil = chunk[(chunk[date_name] >= start_date) & (chunk[date_name] < end_date)]
+            codes = users.get_indexer(df_fil[user_id_name])
+            values = df_fil[value_name].to_numpy(dtype=float)
+            mask = (codes >= 0) & ~np.isnan(values)
+        with stage('groupby'):
+            sums += np.bincount(codes[mask], weights=values[mask], minlength=len(users))
+            counts += np.bincount(codes[mask], minlength=len(users))
     
-    df_count_metric = df_filtered.groupby(user_id_name).agg({value_name: 'count'}).rename(columns={value_name: f'{value_name}_count'}).reset_index()
-    df_sum_metric = df_filtered.groupby(user_id_name).agg({value_name: 'sum'}).rename(columns={value_name: f'{value_name}_sum'}).reset_index()
-    df_lin = pd.merge(df_sum_metric, df_count_metric, how='inner', on=user_id_name).fillna(0)
+    with stage('merge'):
+        df_lin = pd.DataFrame({
+            user_id_name: users,
+            f'{value_name}_sum': sums,
+            f'{value_name}_count': counts,
+        })
     
+    total_sum, total_count = sums.sum(), counts.sum()
     if kappa is None:
-        kappa = np.sum(df_lin[f'{value_name}_sum']) / np.sum(df_lin[f'{value_name}_count'])
+        kappa = total_sum / total_count if total_count else float('nan')
     df_lin[metric_name] = df_lin[f'{value_name}_sum'] - kappa * df_lin[f'{value_name}_count']
-    return df_lin[[user_id_name, metric_name]]
\ No newline at end of file
+    return df_lin[[user_id_name, metric_name]]
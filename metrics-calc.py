@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 
+from daily_store import DailyAggregateStore
+from profiling import stage
+
 
 def calculate_sales_metrics(df, cost_name, date_name, sale_id_name, period, filters=None):
     """Вычисляет метрики по продажам.
@@ -14,6 +17,9 @@ def calculate_sales_metrics(df, cost_name, date_name, sale_id_name, period, filt
     date_name - str, название столбца с датой покупки
     sale_id_name - str, название столбца с идентификатором покупки (в одной покупке может быть несколько товаров)
     
+    Вместо df можно передать DailyAggregateStore(path, prefix_sums=False), построенный по cost_name
+    с user_id_name=sale_id_name, тогда метрики считаются по дневным итогам, фильтры не поддерживаются.
+    
     period - dict, словарь с датами начала и конца периода пилота.
         Пример, {'begin': '2020-01-01', 'end': '2020-01-08'}.
         Дата начала периода входит в полуинтервал, а дата окончания нет,
@@ -32,26 +38,115 @@ def calculate_sales_metrics(df, cost_name, date_name, sale_id_name, period, filt
     calendar = pd.date_range(start_date, end_date, freq = "D").to_frame(name=date_name, index=False)
     calendar_mod = calendar.iloc[:len(calendar) - 1, :]
     
-    if filters:
-        for key, val in filters.items():
-            df = df[df[key].isin(val)]
+    if isinstance(df, DailyAggregateStore):
+        if filters:
+            raise ValueError('Filters are not supported for DailyAggregateStore.')
+        daily = df.get_daily_aggregates(period)
+        full_data = pd.DataFrame({
+            'revenue': daily['sum'],
+            'number_purchases': daily['n_users'],
+            'average_check': daily['sum'] / daily['n_users'],
+            'average_number_items': daily['count'] / daily['n_users'],
+        }).rename_axis(date_name).reset_index()
+        res_ = pd.merge(calendar_mod, full_data, how='left', on=date_name)
+        return res_.set_index(date_name).fillna(0).astype(float)
+    
+    with stage('filter'):
+        if filters:
+            for key, val in filters.items():
+                df = df[df[key].isin(val)]
     
-    df_sort = df[(df[date_name] >= start_date) & (df[date_name] < end_date)].sort_values(date_name)
+        df_sort = df[(df[date_name] >= start_date) & (df[date_name] < end_date)].sort_values(date_name)
 
-    revenue_by_date = df_sort.groupby(date_name).agg({cost_name: 'sum'}).rename(columns={cost_name: 'revenue'})
+    with stage('groupby'):
+        revenue_by_date = df_sort.groupby(date_name).agg({cost_name: 'sum'}).rename(columns={cost_name: 'revenue'})
     
-    number_purchases_by_date = df_sort.groupby(date_name)[sale_id_name].nunique().to_frame().rename(columns={sale_id_name: 'number_purchases'})
+        number_purchases_by_date = df_sort.groupby(date_name)[sale_id_name].nunique().to_frame().rename(columns={sale_id_name: 'number_purchases'})
     
-    average_check_by_purchase = df_sort.groupby([date_name, sale_id_name]).agg({cost_name: 'sum'}).reset_index()[[date_name, cost_name]].set_index(date_name).rename(columns={cost_name: 'average_check'})
-    average_check_by_date = average_check_by_purchase.groupby(date_name).mean()
+        average_check_by_purchase = df_sort.groupby([date_name, sale_id_name]).agg({cost_name: 'sum'}).reset_index()[[date_name, cost_name]].set_index(date_name).rename(columns={cost_name: 'average_check'})
+        average_check_by_date = average_check_by_purchase.groupby(date_name).mean()
+    
+        average_number_items_by_purchase = df_sort.groupby([date_name, sale_id_name]).agg({sale_id_name: 'count'}).rename(columns={sale_id_name: 'average_number_items'})
+        average_number_items_by_date = average_number_items_by_purchase.groupby(date_name).mean()
+    
+        full_data = pd.concat([revenue_by_date, number_purchases_by_date, average_check_by_date, average_number_items_by_date], axis=1).reset_index()
+        full_data[date_name] = pd.to_datetime(full_data[date_name])
+
+    with stage('merge'):
+        res_ = pd.merge(calendar_mod, full_data, how='left', on=date_name)
+        res = res_.set_index(date_name).fillna(0)
+    
+    return res
+
+def calculate_sales_metrics_cube(
+    df, cost_name, date_name, sale_id_name, period, dimensions, filters=None, total_label='all'
+):
+    """Вычисляет метрики по продажам по дням сразу для нескольких срезов.
+
+    Сначала один раз строится агрегат на уровне покупки: сумма стоимости и кол-во товаров
+    для каждой пары (дата, покупка) и значений всех измерений. Метрики всех срезов
+    считаются по этому агрегату, а не по исходным данным.
+
+    df - pd.DataFrame, датафрейм с данными, как в calculate_sales_metrics
+    cost_name - str, название столбца с стоимостью товара
+    date_name - str, название столбца с датой покупки
+    sale_id_name - str, название столбца с идентификатором покупки
+    period - dict, словарь с датами начала и конца периода, как в calculate_sales_metrics
+    dimensions - List[List[str]], список срезов, срез - список столбцов для группировки.
+        Например, [[], ['shop_id'], ['shop_id', 'segment']]. Пустой срез - метрики по всем данным.
+    filters - dict, словарь с фильтрами, как в calculate_sales_metrics. Если None, то фильтровать не нужно.
+    total_label - значение в индексе для измерений, которых нет в срезе.
+
+    return - pd.DataFrame, индекс - MultiIndex из всех измерений и даты, для каждого значения
+        среза в индексе все даты из указанного периода,
+        столбцы - метрики ['revenue', 'number_purchases', 'average_check', 'average_number_items'].
+    """
+    start_date = period['begin']
+    end_date = period['end']
+    calendar = pd.date_range(start_date, end_date, freq = "D")[:-1].rename(date_name)
     
-    average_number_items_by_purchase = df_sort.groupby([date_name, sale_id_name]).agg({sale_id_name: 'count'}).rename(columns={sale_id_name: 'average_number_items'})
-    average_number_items_by_date = average_number_items_by_purchase.groupby(date_name).mean()
+    if filters:
+        for key, val in filters.items():
+            df = df[df[key].isin(val)]
+    df = df[(df[date_name] >= start_date) & (df[date_name] < end_date)]
     
-    full_data = pd.concat([revenue_by_date, number_purchases_by_date, average_check_by_date, average_number_items_by_date], axis=1).reset_index()
-    full_data[date_name] = pd.to_datetime(full_data[date_name])
+    all_dimensions = list(dict.fromkeys(dim for dims in dimensions for dim in dims))
+    # пропуски в измерениях сохраняем, иначе строки пропадут из всех срезов, включая общий
+    sales = df.groupby([date_name, sale_id_name] + all_dimensions, sort=False, dropna=False).agg(
+        cost=(cost_name, 'sum'), items=(cost_name, 'size')
+    ).reset_index()
+    sales[date_name] = pd.to_datetime(sales[date_name])
     
-    res_ = pd.merge(calendar_mod, full_data, how='left', on=date_name)
-    res = res_.set_index(date_name).fillna(0)
+    metric_names = ['revenue', 'number_purchases', 'average_check', 'average_number_items']
+    cube = []
+    for dims in dimensions:
+        dims = list(dims)
+        # покупка может попасть в несколько строк, если её товары различаются по измерениям вне среза,
+        # строки с пропусками отбрасываются только в срезах по этим измерениям
+        sales_by_dims = sales.dropna(subset=dims).groupby(
+            dims + [date_name, sale_id_name], sort=False, dropna=False
+        )[['cost', 'items']].sum()
+        metrics = sales_by_dims.groupby(dims + [date_name]).agg(
+            revenue=('cost', 'sum'),
+            number_purchases=('cost', 'size'),
+            average_check=('cost', 'mean'),
+            average_number_items=('items', 'mean'),
+        )
+        
+        if dims:
+            dims_values = metrics.index.droplevel(date_name).unique()
+            full_index = pd.MultiIndex.from_arrays(
+                [dims_values.get_level_values(i).repeat(len(calendar)) for i in range(len(dims))]
+                + [np.tile(calendar, len(dims_values))],
+                names=dims + [date_name]
+            )
+        else:
+            full_index = calendar
+        metrics = metrics.reindex(full_index, fill_value=0).astype(float).reset_index()
+        for dim in all_dimensions:
+            if dim not in dims:
+                metrics[dim] = total_label
+        cube.append(metrics[all_dimensions + [date_name] + metric_names])
     
-    return res
\ No newline at end of file
+    res = pd.concat(cube, ignore_index=True).set_index(all_dimensions + [date_name])
+    return res
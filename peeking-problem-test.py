@@ -1,10 +1,13 @@
+import json
+import os
+
 import numpy as np
 import pandas as pd
 
 class SequentialTester:
     def __init__(
         self, metric_name, time_column_name,
-        alpha, beta, pdf_one, pdf_two
+        alpha, beta, pdf_one, pdf_two, keep_history=False
     ):
         """Создаём класс для проверки гипотезы о равенстве средних тестом Вальда.
 
@@ -17,6 +20,9 @@ class SequentialTester:
         :param beta: float, допустимая ошибка второго рода.
         :param pdf_one: function, функция плотности распределения метрики при H0.
         :param pdf_two: function, функция плотности распределения метрики при H1.
+        :param keep_history: bool, сохранять ли все добавленные данные в data_control_history
+            и data_pilot_history. Для проверки гипотезы история не нужна: хранится только
+            накопленная сумма логарифмов отношения правдоподобия, кол-во данных и решение.
         """
         self.metric_name = metric_name
         self.time_column_name = time_column_name
@@ -28,8 +34,18 @@ class SequentialTester:
         self.lower_bound = np.log(self.beta / (1 - self.alpha))
         self.upper_bound = np.log((1 - self.beta) / self.alpha)
 
+        self.keep_history = keep_history
         self.data_control_history = None
         self.data_pilot_history = None
+
+        self.is_started = False
+        self.log_lr_sum = 0.0
+        self.length = 0
+        self.result = 0.5
+        self.decision_length = None
+        # значения без пары из другой группы, ждут следующих данных
+        self.pending_control = np.array([])
+        self.pending_pilot = np.array([])
         
 
     def run_test(self, data_control, data_pilot):
@@ -51,9 +67,8 @@ class SequentialTester:
         """
         # YOUR_CODE_HERE
 
-        if (self.data_pilot_history is None) & (self.data_control_history is None):
-            self.data_pilot_history = data_pilot.sort_values(self.time_column_name)
-            self.data_control_history = data_control.sort_values(self.time_column_name)
+        if not self.is_started:
+            self.add_data(data_control, data_pilot)
 
         min_len = min([len(data_control), len(data_pilot)])
         data_one = data_control[:min_len][self.metric_name]
@@ -101,8 +116,324 @@ class SequentialTester:
         data_control = data_control.sort_values(self.time_column_name)
         data_pilot = data_pilot.sort_values(self.time_column_name)
 
-        self.data_control_history = pd.concat([self.data_control_history, data_control], ignore_index=True)
-        self.data_pilot_history = pd.concat([self.data_pilot_history, data_pilot], ignore_index=True)
+        if self.keep_history:
+            self.data_control_history = pd.concat([self.data_control_history, data_control], ignore_index=True)
+            self.data_pilot_history = pd.concat([self.data_pilot_history, data_pilot], ignore_index=True)
+
+        return self.update(
+            data_control[self.metric_name].to_numpy(), data_pilot[self.metric_name].to_numpy()
+        )
+
+    def update(self, values_control, values_pilot):
+        """
+        Добавляет новые значения метрики, проверяет гипотезу о равенстве средних.
+
+        Время работы пропорционально размеру новых данных: к накопленной сумме логарифмов
+        отношения правдоподобия добавляется кумулятивная сумма по новым парам значений.
+        Значения, для которых ещё нет пары из другой группы, ждут следующего вызова.
+        После принятия решения новые данные не меняют результат.
+
+        :param values_control: np.array, новые значения метрики контрольной группы в порядке времени.
+        :param values_pilot: np.array, новые значения метрики пилотной группы в порядке времени.
+
+        :return (result, length): то же, что и в add_data.
+        """
+        self.is_started = True
+        if self.decision_length is not None:
+            return self.result, self.decision_length
+
+        values_control = np.concatenate([self.pending_control, values_control])
+        values_pilot = np.concatenate([self.pending_pilot, values_pilot])
+        min_len = min([len(values_control), len(values_pilot)])
+        self.pending_control = values_control[min_len:]
+        self.pending_pilot = values_pilot[min_len:]
+        if min_len == 0:
+            return self.result, self.length
+
+        delta_data = values_pilot[:min_len] - values_control[:min_len]
+        z = self.log_lr_sum + np.cumsum(np.log(self.pdf_two(delta_data) / self.pdf_one(delta_data)))
+
+        indexes_lower = np.flatnonzero(z < self.lower_bound)
+        indexes_upper = np.flatnonzero(z > self.upper_bound)
+
+        first_index_lower = indexes_lower[0] if len(indexes_lower) > 0 else min_len + 1
+        first_index_upper = indexes_upper[0] if len(indexes_upper) > 0 else min_len + 1
+
+        if first_index_lower < first_index_upper:
+            self.result = 0
+            self.decision_length = self.length + first_index_lower + 1
+            return self.result, self.decision_length
+        elif first_index_lower > first_index_upper:
+            self.result = 1
+            self.decision_length = self.length + first_index_upper + 1
+            return self.result, self.decision_length
+
+        self.log_lr_sum = z[-1]
+        self.length += min_len
+        return self.result, self.length
+
+    def get_state(self):
+        """
+        Возвращает компактное состояние теста для сохранения и продолжения без повторной обработки данных.
+
+        :return state: dict, состояние теста из встроенных типов python.
+        """
+        return {
+            'is_started': self.is_started,
+            'log_lr_sum': float(self.log_lr_sum),
+            'length': int(self.length),
+            'result': self.result,
+            'decision_length': None if self.decision_length is None else int(self.decision_length),
+            'pending_control': self.pending_control.tolist(),
+            'pending_pilot': self.pending_pilot.tolist(),
+        }
+
+    def set_state(self, state):
+        """
+        Восстанавливает состояние теста, полученное из get_state.
+
+        :param state: dict, состояние теста.
+        """
+        self.is_started = state['is_started']
+        self.log_lr_sum = state['log_lr_sum']
+        self.length = state['length']
+        self.result = state['result']
+        self.decision_length = state['decision_length']
+        self.pending_control = np.array(state['pending_control'], dtype=float)
+        self.pending_pilot = np.array(state['pending_pilot'], dtype=float)
+
+
+class SequentialTestManager:
+    def __init__(
+        self, experiment_column_name='experiment_id', metric_column_name='metric_name',
+        group_column_name='group', value_column_name='value', time_column_name='time'
+    ):
+        """Создаём менеджер последовательных тестов для множества пар (эксперимент, метрика).
+
+        События приходят батчами в длинном формате: одна строка - одно измерение метрики
+        пользователя из пилотной или контрольной группы эксперимента.
+
+        :param experiment_column_name: str, название столбца с идентификатором эксперимента.
+        :param metric_column_name: str, название столбца с названием метрики.
+        :param group_column_name: str, название столбца с группой, значения 'pilot' или 'control'.
+        :param value_column_name: str, название стобца со значениями измерений.
+        :param time_column_name: str, названия столбца с датой и временем измерения.
+        """
+        self.experiment_column_name = experiment_column_name
+        self.metric_column_name = metric_column_name
+        self.group_column_name = group_column_name
+        self.value_column_name = value_column_name
+        self.time_column_name = time_column_name
+        self.testers = {}
+
+    def add_tester(self, experiment_id, metric_name, alpha, beta, pdf_one, pdf_two):
+        """
+        Регистрирует последовательный тест для пары (эксперимент, метрика).
+
+        :param experiment_id: идентификатор эксперимента. Скаляры numpy (например, из столбца датафрейма)
+            приводятся к встроенным типам python, чтобы состояние можно было сохранить в json.
+        :param metric_name: str, название метрики.
+        :param alpha, beta, pdf_one, pdf_two: параметры SequentialTester.
+        """
+        if isinstance(experiment_id, np.generic):
+            experiment_id = experiment_id.item()
+        if isinstance(metric_name, np.generic):
+            metric_name = metric_name.item()
+        self.testers[(experiment_id, metric_name)] = SequentialTester(
+            self.value_column_name, self.time_column_name, alpha, beta, pdf_one, pdf_two
+        )
+
+    def process_batch(self, records):
+        """
+        Обрабатывает батч событий, обновляет все затронутые тесты.
+
+        События без зарегистрированного теста пропускаются, пустой батч ничего не меняет.
+        Значения группы должны быть 'pilot' или 'control', иначе ValueError до обработки батча.
+
+        :param records: pd.DataFrame or List[dict], батч событий.
+
+        :return decisions: List[tuple], тесты, которые приняли решение на этом батче,
+            в виде (experiment_id, metric_name, result, length).
+        """
+        if len(records) == 0:
+            return []
+        if not isinstance(records, pd.DataFrame):
+            records = pd.DataFrame(records)
+        unknown_groups = set(records[self.group_column_name].unique()) - {'pilot', 'control'}
+        if unknown_groups:
+            raise ValueError(f'Unknown group values: {sorted(map(str, unknown_groups))}, expected pilot/control.')
+        records = records.sort_values(self.time_column_name, kind='stable')
+
+        decisions = []
+        key_columns = [self.experiment_column_name, self.metric_column_name]
+        for key, key_records in records.groupby(key_columns, sort=False):
+            tester = self.testers.get(key)
+            if tester is None or tester.decision_length is not None:
+                continue
+            is_pilot = (key_records[self.group_column_name] == 'pilot').to_numpy()
+            values = key_records[self.value_column_name].to_numpy(dtype=float)
+            result, length = tester.update(values[~is_pilot], values[is_pilot])
+            if tester.decision_length is not None:
+                decisions.append((*key, result, length))
+        return decisions
+
+    def process_stream(self, batches):
+        """
+        Обрабатывает итератор батчей событий, отдаёт решения сразу после пересечения границы.
+
+        :param batches: iterable, батчи событий в формате process_batch.
+
+        :yield decision: tuple, (experiment_id, metric_name, result, length).
+        """
+        for records in batches:
+            yield from self.process_batch(records)
+
+    async def process_queue(self, queue):
+        """
+        Обрабатывает батчи событий из asyncio.Queue, пока не встретит None.
+
+        :param queue: asyncio.Queue, очередь с батчами событий в формате process_batch.
+
+        :yield decision: tuple, (experiment_id, metric_name, result, length).
+        """
+        while True:
+            records = await queue.get()
+            if records is None:
+                break
+            for decision in self.process_batch(records):
+                yield decision
+
+    def save_checkpoint(self, path):
+        """
+        Сохраняет состояния всех тестов в json файл.
+
+        :param path: str, путь к файлу.
+        """
+        states = [
+            {'experiment_id': key[0], 'metric_name': key[1], 'state': tester.get_state()}
+            for key, tester in self.testers.items()
+        ]
+        # пишем во временный файл и подменяем одной операцией, чтобы сбой не испортил прошлую точку
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(states, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load_checkpoint(self, path):
+        """
+        Восстанавливает состояния тестов из файла save_checkpoint.
+
+        Тесты должны быть заранее зарегистрированы через add_tester,
+        так как функции плотности не сохраняются.
+
+        :param path: str, путь к файлу.
+        """
+        with open(path) as f:
+            states = json.load(f)
+        for item in states:
+            key = (item['experiment_id'], item['metric_name'])
+            if key in self.testers:
+                self.testers[key].set_state(item['state'])
+
+
+def make_delta_sampler(values_control, values_pilot=None, shift=0):
+    """Создаёт функцию генерации разностей pilot - control по эмпирическим распределениям метрики.
+
+    :param values_control: np.array, значения метрики контрольной группы.
+    :param values_pilot: np.array or None, значения метрики пилотной группы. Если None, то берутся
+        значения контрольной группы (нулевая гипотеза).
+    :param shift: float, эффект, который добавляется к значениям пилотной группы.
+
+    :return sampler: function(rng, shape) -> np.array, разности значений пилотной и контрольной групп.
+    """
+    values_control = np.asarray(values_control, dtype=float)
+    values_pilot = values_control if values_pilot is None else np.asarray(values_pilot, dtype=float)
+
+    def sampler(rng, shape):
+        return rng.choice(values_pilot, shape) + shift - rng.choice(values_control, shape)
+
+    return sampler
+
+
+def simulate_sequential_tests(tester, sampler, n_sim=10000, max_length=10000, chunk_length=100, seed=None):
+    """Моделирует n_sim последовательных тестов сразу в виде двумерного массива кумулятивных сумм.
+
+    Данные генерируются блоками по chunk_length измерений, для каждой строки ищется первое
+    пересечение границ tester.lower_bound и tester.upper_bound. Строки, принявшие решение,
+    исключаются из следующих блоков.
+
+    :param tester: SequentialTester, тест с функциями плотности и границами.
+    :param sampler: function(rng, shape) -> np.array, генерирует разности pilot - control.
+    :param n_sim: int, кол-во моделируемых тестов.
+    :param max_length: int, максимальное кол-во данных в одном тесте.
+    :param chunk_length: int, кол-во измерений, генерируемых за раз для каждого теста.
+    :param seed: int or None, состояние генератора случайных чисел.
+
+    :return (results, lengths):
+        results: np.array, 0 - отклоняем H1, 1 - отклоняем H0, 0.5 - недостаточно данных
+        lengths: np.array, сколько потребовалось данных для принятия решения.
+    """
+    rng = np.random.default_rng(seed)
+    results = np.full(n_sim, 0.5)
+    lengths = np.full(n_sim, max_length)
+    active = np.arange(n_sim)
+    z_last = np.zeros(n_sim)
+    for begin in range(0, max_length, chunk_length):
+        if len(active) == 0:
+            break
+        size = min(chunk_length, max_length - begin)
+        delta_data = sampler(rng, (len(active), size))
+        log_lr = np.log(tester.pdf_two(delta_data) / tester.pdf_one(delta_data))
+        z = z_last[:, None] + np.cumsum(log_lr, axis=1)
+
+        crossed = (z < tester.lower_bound) | (z > tester.upper_bound)
+        is_finished = crossed.any(axis=1)
+        first_index = crossed.argmax(axis=1)[is_finished]
+        finished = active[is_finished]
+        results[finished] = (z[is_finished, first_index] > tester.upper_bound).astype(float)
+        lengths[finished] = begin + first_index + 1
+
+        active = active[~is_finished]
+        z_last = z[~is_finished, -1]
+    return results, lengths
+
+
+def estimate_operating_characteristics(
+    tester, sampler_h0, sampler_h1, n_sim=10000, max_length=10000, chunk_length=100, seed=None
+):
+    """Оценивает ошибки первого и второго рода и среднее кол-во данных до решения (ASN) моделированием.
 
-        return self.run_test(self.data_control_history, self.data_pilot_history)
+    :param tester: SequentialTester, тест с функциями плотности и границами.
+    :param sampler_h0: function(rng, shape) -> np.array, генерирует разности pilot - control при H0.
+    :param sampler_h1: function(rng, shape) -> np.array, генерирует разности pilot - control при H1.
+    :param n_sim: int, кол-во моделируемых тестов для каждой гипотезы.
+    :param max_length: int, максимальное кол-во данных в одном тесте.
+    :param chunk_length: int, кол-во измерений, генерируемых за раз для каждого теста.
+    :param seed: int or None, состояние генератора случайных чисел.
 
+    :return dict:
+        alpha - доля отклонений H0 при верной H0,
+        beta - доля отклонений H1 при верной H1,
+        asn_h0, asn_h1 - среднее кол-во данных до решения при H0 и H1,
+        undecided_h0, undecided_h1 - доля тестов без решения за max_length.
+    """
+    seed_h0, seed_h1 = np.random.SeedSequence(seed).spawn(2)
+    results_h0, lengths_h0 = simulate_sequential_tests(
+        tester, sampler_h0, n_sim, max_length, chunk_length, seed_h0
+    )
+    results_h1, lengths_h1 = simulate_sequential_tests(
+        tester, sampler_h1, n_sim, max_length, chunk_length, seed_h1
+    )
+    return {
+        'alpha': np.mean(results_h0 == 1),
+        'beta': np.mean(results_h1 == 0),
+        'asn_h0': np.mean(lengths_h0),
+        'asn_h1': np.mean(lengths_h1),
+        'undecided_h0': np.mean(results_h0 == 0.5),
+        'undecided_h1': np.mean(results_h1 == 0.5),
+    }
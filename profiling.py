@@ -0,0 +1,45 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+_stage_timings = None
+
+
+@contextmanager
+def stage(name):
+    """Замеряет время этапа функции, если включён сбор замеров (record_stages).
+
+    Когда сбор выключен, ничего не делает, поэтому оставлен внутри функций постоянно.
+
+    name - str, название этапа, например 'filter', 'groupby', 'merge', 'test'
+    """
+    if _stage_timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_timings[name].append(time.perf_counter() - start)
+
+
+@contextmanager
+def record_stages():
+    """Включает сбор замеров этапов на время блока with.
+
+    Пример:
+        with record_stages() as timings:
+            calculate_metric_cuped(...)
+        timings - dict, {этап: список длительностей в секундах}
+
+    return - dict, заполняется замерами по мере выполнения
+    """
+    global _stage_timings
+    previous = _stage_timings
+    _stage_timings = defaultdict(list)
+    timings = _stage_timings
+    try:
+        yield timings
+    finally:
+        _stage_timings = previous
@@ -2,6 +2,40 @@ import numpy as np
 import pandas as pd
 from scipy.stats import norm
 
+from cuped import calculate_period_metrics, calculate_theta
+
+
+def estimate_sample_size_grid(mu, std, effects, alphas=0.05, betas=0.2):
+    """Оцениваем sample size сразу для сетки метрик, эффектов, ошибок первого и второго рода.
+
+    Все аргументы приводятся к массивам и транслируются (broadcast) друг с другом
+    по осям (метрика, эффект, alpha, beta).
+
+    mu - float or np.array, средние значения метрик
+    std - float or np.array, стандартные отклонения метрик
+    effects - float or List[float], ожидаемые эффекты. Например, [1.03] - увеличение на 3%
+    alphas - float or List[float], ошибки первого рода
+    betas - float or List[float], ошибки второго рода
+
+    return - np.array формы (кол-во метрик, кол-во эффектов, кол-во alpha, кол-во beta) с sample size (float).
+        Если sample size не определён (нулевой эффект, mu = 0 или пропуски), то np.nan.
+    """
+    mu = np.asarray(mu, dtype=float).reshape(-1, 1, 1, 1)
+    std = np.asarray(std, dtype=float).reshape(-1, 1, 1, 1)
+    effects = np.asarray(effects, dtype=float).reshape(1, -1, 1, 1)
+    alphas = np.asarray(alphas, dtype=float).reshape(1, 1, -1, 1)
+    betas = np.asarray(betas, dtype=float).reshape(1, 1, 1, -1)
+
+    t_alpha = norm.ppf(1 - alphas / 2, loc=0, scale=1)
+    t_beta = norm.ppf(1 - betas, loc=0, scale=1)
+    z_scores_sum_squared = (t_alpha + t_beta) ** 2
+    epsilon = (effects - 1) * mu
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sample_sizes = np.ceil(z_scores_sum_squared * (2 * std ** 2) / (epsilon ** 2))
+    # не приводим к int: inf превратился бы в отрицательное число
+    sample_sizes[~np.isfinite(sample_sizes)] = np.nan
+    return sample_sizes
+
 
 def estimate_sample_size(df, metric_name, effects, alpha=0.05, beta=0.2):
     """Оцениваем sample size для списка эффектов.
@@ -15,21 +49,132 @@ def estimate_sample_size(df, metric_name, effects, alpha=0.05, beta=0.2):
     return - pd.DataFrame со столбцами ['effect', 'sample_size']    
     """
     # YOUR_CODE_HERE
-    t_alpha = norm.ppf(1 - alpha / 2, loc=0, scale=1)
-    t_beta = norm.ppf(1 - beta, loc=0, scale=1)
-    z_scores_sum_squared = (t_alpha + t_beta) ** 2
     mu = np.mean(df[metric_name])
     std = np.std(df[metric_name])
     
-    res = []
-    for eff in effects:
-        epsilon = (eff - 1) * mu
-        sample_size = int(
-                np.ceil(
-                    z_scores_sum_squared * (2 * std ** 2) / (epsilon ** 2)
-                )
-            )
-        res.append((eff, sample_size))
-    result = pd.DataFrame(res, columns = ['effect', 'sample_size'])
+    sample_sizes = estimate_sample_size_grid(mu, std, effects, alpha, beta).ravel()
+    if np.isnan(sample_sizes).any():
+        raise ValueError('Sample size is undefined: effect must differ from 1 and metric mean from 0.')
+    sample_sizes = sample_sizes.astype(int)
+    result = pd.DataFrame({'effect': effects, 'sample_size': sample_sizes})
     return result
-    
\ No newline at end of file
+
+
+def estimate_sample_size_variance_reduced(
+    df, value_name, user_id_name, list_user_id, date_name, periods, effects, alpha=0.05, beta=0.2
+):
+    """Оцениваем sample size для исходной метрики и её версий после CUPED и линеаризации.
+
+    Суммы и кол-во значений по пользователям за оба периода считаются за один проход по данным
+    (cuped.calculate_period_metrics). Метрика - сумма value_name по пользователю за период 'pilot'.
+    CUPED использует в качестве ковариаты ту же метрику за период 'prepilot', как
+    cuped.calculate_metric_cuped. Линеаризация - ratio-метрика sum / count, как
+    linearization.calculate_linearized_metric c kappa по имеющимся данным.
+    Средние вариантов разные (у линеаризованной метрики оно равно нулю, у CUPED сдвинуто
+    на theta * mean(prepilot)), но преобразования не меняют разницу между группами: эффект
+    в абсолютных единицах у всех трёх одинаковый, (effect - 1) * mean(sum). Поэтому sample size
+    считается с общим mu = mean(sum) и собственным стандартным отклонением каждого варианта.
+
+    df - pd.DataFrame, датафрейм с данными
+    value_name - str, название столбца со значениями для вычисления целевой метрики
+    user_id_name - str, название столбца с идентификаторами пользователей
+    list_user_id - List[int], список идентификаторов пользователей
+    date_name - str, название столбца с датами
+    periods - dict, словарь с датами начала и конца периода 'pilot' (период, по которому оцениваем метрику)
+        и 'prepilot' (период для ковариаты CUPED), в формате cuped.calculate_metric_cuped.
+    effects - List[float], список ожидаемых эффектов. Например, [1.03] - увеличение на 3%
+    alpha - float, ошибка первого рода
+    beta - float, ошибка второго рода
+
+    return - pd.DataFrame со столбцами ['effect', 'sample_size', 'sample_size_cuped', 'sample_size_linearized'],
+        np.nan, если sample size не определён (см. estimate_sample_size_grid)
+    """
+    period_df = calculate_period_metrics(
+        df, value_name, user_id_name, list_user_id, date_name, periods, with_count=True
+    )
+    y_pilot = period_df['pilot']
+    y_prepilot = period_df['prepilot']
+    y_count = period_df['pilot_count']
+
+    theta = calculate_theta(y_prepilot, y_pilot)
+    kappa = np.sum(y_pilot) / np.sum(y_count)
+    stds = [
+        np.std(y_pilot),
+        np.std(y_pilot - theta * y_prepilot),
+        np.std(y_pilot - kappa * y_count),
+    ]
+    mu = np.mean(y_pilot)
+
+    sample_sizes = estimate_sample_size_grid([mu] * len(stds), stds, effects, alpha, beta)[:, :, 0, 0]
+    result = pd.DataFrame({
+        'effect': effects,
+        'sample_size': sample_sizes[0],
+        'sample_size_cuped': sample_sizes[1],
+        'sample_size_linearized': sample_sizes[2],
+    })
+    return result
+
+
+class MetricMomentsCache:
+    def __init__(self):
+        """Кеш моментов метрик для планирования экспериментов.
+
+        Для каждой пары (датасет, метрика) хранит кол-во значений, среднее и сумму квадратов
+        отклонений. При поступлении новых данных моменты объединяются с накопленными,
+        поэтому весь датасет повторно не читается.
+        """
+        self.moments = {}
+
+    def update(self, dataset_key, df, metric_names):
+        """
+        Добавляет новые данные датасета, например, за новый день.
+
+        :param dataset_key: идентификатор датасета.
+        :param df: pd.DataFrame, новые данные.
+        :param metric_names: List[str], названия столбцов с метриками.
+        """
+        for metric_name in metric_names:
+            values = df[metric_name].to_numpy(dtype=float)
+            if len(values) == 0:
+                continue
+            count, mean, m2 = self.moments.get((dataset_key, metric_name), (0, 0.0, 0.0))
+            new_mean = values.mean()
+            new_m2 = ((values - new_mean) ** 2).sum()
+            total = count + len(values)
+            delta = new_mean - mean
+            self.moments[(dataset_key, metric_name)] = (
+                total,
+                mean + delta * len(values) / total,
+                m2 + new_m2 + delta ** 2 * count * len(values) / total,
+            )
+
+    def get(self, dataset_key, metric_name):
+        """
+        Возвращает среднее и стандартное отклонение метрики (как np.mean и np.std).
+
+        :return (mu, std): float, float.
+        """
+        count, mean, m2 = self.moments[(dataset_key, metric_name)]
+        return mean, np.sqrt(m2 / count)
+
+    def estimate_sample_sizes(self, dataset_key, metric_names, effects, alphas=0.05, betas=0.2):
+        """
+        Оцениваем sample size для сетки метрик, эффектов, ошибок первого и второго рода.
+
+        :param dataset_key: идентификатор датасета.
+        :param metric_names: List[str], названия метрик.
+        :param effects: List[float], ожидаемые эффекты.
+        :param alphas: float or List[float], ошибки первого рода.
+        :param betas: float or List[float], ошибки второго рода.
+
+        :return pd.DataFrame со столбцами ['metric_name', 'effect', 'alpha', 'beta', 'sample_size'],
+            np.nan, если sample size не определён (см. estimate_sample_size_grid).
+        """
+        mu, std = zip(*[self.get(dataset_key, metric_name) for metric_name in metric_names])
+        alphas, betas = np.atleast_1d(alphas), np.atleast_1d(betas)
+        sample_sizes = estimate_sample_size_grid(mu, std, effects, alphas, betas)
+        index = pd.MultiIndex.from_product(
+            [metric_names, effects, alphas, betas], names=['metric_name', 'effect', 'alpha', 'beta']
+        )
+        result = pd.DataFrame({'sample_size': sample_sizes.ravel()}, index=index).reset_index()
+        return result
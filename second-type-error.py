@@ -1,13 +1,25 @@
 import numpy as np
-import pandas as pd
-from scipy.stats import ttest_ind
 
+from bootstrap import (
+    calculate_bootstrap_moments, calculate_bootstrap_moments_parallel,
+    calculate_poisson_bootstrap_moments, calculate_split_moments, ttest_from_moments,
+    ttest_from_standard_errors
+)
+from profiling import stage
+from stratification import calculate_stratified_moments, get_strata_weights
 
-def estimate_second_type_error(df_pilot_group, df_control_group, metric_name, effects, alpha=0.05, n_iter=10000, seed=None):
+
+def estimate_second_type_error(
+    df_pilot_group, df_control_group, metric_name, effects, alpha=0.05, n_iter=10000, seed=None,
+    equal_var=True, chunk_size=1000, n_jobs=None, block_size=None, bootstrap_method='index'
+):
     """Оцениваем ошибки второго рода.
 
     Бутстрепим выборки из пилотной и контрольной групп тех же размеров, добавляем эффект к пилотной группе,
     считаем долю случаев без значимых отличий.
+    Моменты бутстрепных выборок считаются один раз: умножение пилотной выборки на eff
+    умножает её среднее на eff, а дисперсию на eff ** 2, поэтому статистики для всех эффектов
+    получаются за один векторизованный проход.
     
     df_pilot_group - pd.DataFrame, датафрейм с данными пилотной группы
     df_control_group - pd.DataFrame, датафрейм с данными контрольной группы
@@ -16,30 +28,135 @@ def estimate_second_type_error(df_pilot_group, df_control_group, metric_name, ef
     alpha - float, уровень значимости для статтеста
     n_iter - int, кол-во итераций бутстрапа
     seed - int or None, состояние генератора случайных чисел
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    chunk_size - int, кол-во строк матрицы бутстрапа, которые генерируются за раз
+    n_jobs - int or None, кол-во процессов для бутстрапа. Если None, то бутстреп в одном процессе
+        с глобальным генератором np.random, как раньше. Иначе итерации делятся на блоки
+        с собственными генераторами из seed, результат не зависит от значения n_jobs.
+    block_size - int or None, кол-во итераций бутстрапа в одном блоке, если n_jobs не None.
+        Если None, то подбирается так, чтобы в блоке было не больше 10 млн элементов.
+    bootstrap_method - str, способ семплирования, если n_jobs не None: 'index' - индексы элементов,
+        'poisson' - веса пуассоновского бутстрапа
 
     return - dict, {размер_эффекта: ошибка_второго_рода}
     """
-    # YOUR_CODE_HERE
-    np.random.seed(seed)
-    
-    
-    a_bootstrap = np.random.choice(
-        df_control_group.loc[:,metric_name].to_numpy().ravel(), 
-        size=(len(df_control_group), n_iter)
+    values_control = df_control_group.loc[:,metric_name].to_numpy().ravel()
+    values_pilot = df_pilot_group.loc[:,metric_name].to_numpy().ravel()
+    with stage('bootstrap'):
+        if n_jobs is None:
+            np.random.seed(seed)
+            a_mean, a_var = calculate_bootstrap_moments(values_control, n_iter, chunk_size)
+            b_mean, b_var = calculate_bootstrap_moments(values_pilot, n_iter, chunk_size)
+            a_count, b_count = len(values_control), len(values_pilot)
+        else:
+            a_mean, a_var, a_count, b_mean, b_var, b_count = calculate_bootstrap_moments_parallel(
+                values_control, values_pilot, n_iter, seed, n_jobs, block_size, bootstrap_method
+            )
+
+    effects_column = np.asarray(effects, dtype=float).reshape(-1, 1)
+    with stage('test'):
+        _, pvalues = ttest_from_moments(
+            a_mean, a_var, a_count,
+            b_mean * effects_column, b_var * effects_column ** 2, b_count,
+            equal_var
+        )
+    true_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки II рода
+    beta = 1 - true_positive_tt.mean(axis=1)
+    return {eff: beta[i] for i, eff in enumerate(effects)}
+
+
+def estimate_second_type_error_poisson(
+    df_pilot_group, df_control_group, sum_name, effects, count_name=None, alpha=0.05, n_iter=10000,
+    seed=None, equal_var=True, block_size=None
+):
+    """Оцениваем ошибки второго рода пуассоновским бутстрепом по поюзерным агрегатам.
+
+    Умножение сумм пилотной группы на eff умножает метрику на eff, а её дисперсию на eff ** 2,
+    поэтому бутстреп выполняется один раз для всех эффектов.
+
+    df_pilot_group - pd.DataFrame, датафрейм с агрегатами пилотной группы, одна строка - один пользователь
+    df_control_group - pd.DataFrame, датафрейм с агрегатами контрольной группы
+    sum_name - str, название столбца с суммой метрики по пользователю, например столбец периода
+        из cuped.calculate_period_metrics(..., with_count=True) или 'sum' из DailyAggregateStore.get_user_aggregates
+    effects - List[float], список размеров эффектов ([1.03] - увеличение на 3%).
+    count_name - str or None, название столбца с кол-вом событий по пользователю,
+        например f'{period_name}_count' или 'count' из тех же функций.
+        Если None, то метрика - среднее sum_name по пользователям.
+    alpha - float, уровень значимости для статтеста
+    n_iter - int, кол-во итераций бутстрапа
+    seed - int or None, состояние генератора случайных чисел
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    block_size - int or None, кол-во итераций бутстрапа в одном блоке.
+        Если None, то подбирается так, чтобы в блоке было не больше 10 млн элементов.
+
+    return - dict, {размер_эффекта: ошибка_второго_рода}
+    """
+    seed_control, seed_pilot = np.random.SeedSequence(seed).spawn(2)
+    moments = []
+    for df, group_seed in ((df_control_group, seed_control), (df_pilot_group, seed_pilot)):
+        counts = None if count_name is None else df[count_name].to_numpy()
+        moments.append(calculate_poisson_bootstrap_moments(
+            df[sum_name].to_numpy(), counts, n_iter, block_size, group_seed
+        ))
+    (a_mean, a_var, a_count), (b_mean, b_var, b_count) = moments
+
+    effects_column = np.asarray(effects, dtype=float).reshape(-1, 1)
+    _, pvalues = ttest_from_moments(
+        a_mean, a_var, a_count,
+        b_mean * effects_column, b_var * effects_column ** 2, b_count,
+        equal_var
+    )
+    true_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки II рода
+    beta = 1 - true_positive_tt.mean(axis=1)
+    return {eff: beta[i] for i, eff in enumerate(effects)}
+
+
+def estimate_second_type_error_by_splits(
+    df, metric_name, pilot_indexes, control_indexes, effects, alpha=0.05, equal_var=True, chunk_size=100,
+    strat_columns=None, weights=None
+):
+    """Оцениваем ошибки второго рода по набору готовых разбиений на пилот и контроль.
+
+    Эффект добавляется к пилотной группе каждого разбиения.
+
+    df - pd.DataFrame, датафрейм с данными всех объектов
+    metric_name - str, названия столбца с метрикой
+    pilot_indexes - np.array формы (n_splits, size), позиционные индексы строк df в пилотных группах,
+        например из stratification.select_stratified_indexes
+    control_indexes - np.array формы (n_splits, size), позиционные индексы строк df в контрольных группах
+    effects - List[float], список размеров эффектов ([1.03] - увеличение на 3%).
+    alpha - float, уровень значимости для статтеста
+    equal_var - bool, если True, то t-тест Стьюдента, иначе t-тест Уэлча
+    chunk_size - int, кол-во разбиений, обрабатываемых за раз
+    strat_columns - List[str] or None, столбцы для стратификации. Если заданы, то вместо t-теста
+        по обычным средним используется тест по стратифицированным средним (постстратификация).
+    weights - dict, словарь весов страт, в том же формате, что и в select_stratified_groups.
+        Если None, веса пропорциональны долям страт в df.
+
+    return - dict, {размер_эффекта: ошибка_второго_рода}
+    """
+    values = df[metric_name].to_numpy()
+    effects_column = np.asarray(effects, dtype=float).reshape(-1, 1)
+    if strat_columns is None:
+        a_mean, a_var = calculate_split_moments(values, control_indexes, chunk_size)
+        b_mean, b_var = calculate_split_moments(values, pilot_indexes, chunk_size)
+        _, pvalues = ttest_from_moments(
+            a_mean, a_var, control_indexes.shape[1],
+            b_mean * effects_column, b_var * effects_column ** 2, pilot_indexes.shape[1],
+            equal_var
         )
-    b_bootstrap = np.random.choice(
-        df_pilot_group.loc[:,metric_name].to_numpy().ravel(), 
-        size=(len(df_pilot_group), n_iter)
+    else:
+        strata_codes, strata_weights = get_strata_weights(df, strat_columns, weights)
+        a_mean, a_se2 = calculate_stratified_moments(
+            values, strata_codes, strata_weights, control_indexes, chunk_size
         )
-    
-    res_dict = {}
-    for eff in effects:
-        true_positive_tt = []
-        for i in range(n_iter):
-            a_sample = pd.DataFrame(a_bootstrap).loc[:,i]
-            b_sample = pd.DataFrame(b_bootstrap).loc[:,i] * eff
-            
-            pvalue_ab_tt = ttest_ind(a_sample, b_sample)[1]
-            true_positive_tt.append(int(pvalue_ab_tt < alpha)) # Фиксируем ошибки II рода
-        res_dict[eff] = 1 - np.mean(true_positive_tt)
-    return res_dict
\ No newline at end of file
+        b_mean, b_se2 = calculate_stratified_moments(
+            values, strata_codes, strata_weights, pilot_indexes, chunk_size
+        )
+        _, pvalues = ttest_from_standard_errors(
+            a_mean, a_se2, b_mean * effects_column, b_se2 * effects_column ** 2,
+            control_indexes.shape[1] + pilot_indexes.shape[1] - 2
+        )
+    true_positive_tt = (pvalues < alpha).astype(int) # Фиксируем ошибки II рода
+    beta = 1 - true_positive_tt.mean(axis=1)
+    return {eff: beta[i] for i, eff in enumerate(effects)}
@@ -1,6 +1,66 @@
 import numpy as np
 import pandas as pd
 
+from bootstrap import ttest_from_standard_errors
+from profiling import stage
+
+
+def _get_strata_weights(data, strat_columns, weights=None):
+    """Разбивает объекты на страты и сопоставляет веса страт их кодам.
+
+    Страты факторизуются один раз: каждой строке data сопоставляется целочисленный код страты.
+
+    return (strata_codes, strata_counts, strata_weights):
+        strata_codes - np.array, код страты для каждой строки data
+        strata_counts - np.array, кол-во объектов в каждой страте (по кодам)
+        strata_weights - dict, {код страты: вес}, в порядке страт из weights.
+            Страты, которой нет в data, получают коды за пределами strata_counts.
+    """
+    grouped = data.groupby(strat_columns, dropna=False)
+    strata_codes = grouped.ngroup().to_numpy()
+    strata_counts = grouped.size()
+    strata = list(strata_counts.index)
+    strata_counts = strata_counts.to_numpy()
+    if not weights:
+        weights = {strat: count / len(data) for strat, count in zip(strata, strata_counts)}
+
+    code_by_strat = {strat: code for code, strat in enumerate(strata)}
+    strata_weights = {}
+    for strat, weight in weights.items():
+        if len(strat_columns) > 1:
+            strat = tuple(strat)
+        elif isinstance(strat, tuple):
+            strat = strat[0]
+        code = code_by_strat.get(strat, len(strata) + len(strata_weights))
+        strata_weights[code] = weight
+    return strata_codes, strata_counts, strata_weights
+
+
+def _get_strata_sizes(data, strat_columns, group_size, weights=None):
+    """Разбивает объекты на страты и вычисляет размеры групп в каждой страте.
+
+    return (strata_codes, strata_counts, strata_sizes):
+        strata_codes - np.array, код страты для каждой строки data
+        strata_counts - np.array, кол-во объектов в каждой страте (по кодам)
+        strata_sizes - dict, {код страты: размер группы}, в порядке страт из weights
+    """
+    strata_codes, strata_counts, strata_weights = _get_strata_weights(data, strat_columns, weights)
+    strata_sizes = {code: int(round(group_size * weight)) for code, weight in strata_weights.items()}
+    return strata_codes, strata_counts, strata_sizes
+
+
+def _get_strata_order(strata_codes, rng):
+    """Перемешивает индексы строк внутри страт одним проходом генератора.
+
+    return (order, strata_starts):
+        order - np.array, индексы строк, сгруппированные по стратам в случайном порядке внутри страты
+        strata_starts - np.array, позиция начала каждой страты в order
+    """
+    order = np.lexsort((rng.random(len(strata_codes)), strata_codes))
+    strata_counts = np.bincount(strata_codes)
+    strata_starts = np.concatenate([[0], np.cumsum(strata_counts)[:-1]])
+    return order, strata_starts
+
 
 def select_stratified_groups(data, strat_columns, group_size, weights=None, seed=None):
     """Подбирает стратифицированные группы для эксперимента.
@@ -18,45 +78,171 @@ def select_stratified_groups(data, strat_columns, group_size, weights=None, seed
         c пилотной и контрольной группами.
     """
     # YOUR_CODE_HERE
-    np.random.seed(seed)
-    
-    pilot = pd.DataFrame(columns=strat_columns)
-    control = pd.DataFrame(columns=strat_columns)
-    if weights:
-        for strat, weight in weights.items():
-            if isinstance(strat, (str, int, float)):
-                val_list = []
-                val_list += [strat]
-            else:
-                val_list = list(strat)
-            strat_df = data[data[strat_columns].isin(val_list).all(axis=1)].reset_index(drop=True)
-            ab_group_size = int(round(group_size * weight))
-            random_indexes_ab = np.random.choice([i for i in range(len(strat_df))], ab_group_size * 2, False)
-            a_indexes = random_indexes_ab[:ab_group_size]
-            b_indexes = random_indexes_ab[ab_group_size:]
-            a_random_strata_df = strat_df.iloc[a_indexes,:]
-            b_random_strata_df = strat_df.iloc[b_indexes,:]
-  
-            control = pd.concat([control, a_random_strata_df], ignore_index=True)
-            pilot = pd.concat([pilot, b_random_strata_df], ignore_index=True)
-    else:
-        strat_dict = data.groupby(strat_columns).count().iloc[:,0].to_dict()
-        len_data = len(data)
-        strat_dict_shares = {strata:share/len_data for (strata, share) in strat_dict.items()}
-        for strat, weight in strat_dict_shares.items():
-            if isinstance(strat, (str, int, float)):
-                val_list = []
-                val_list += [strat]
-            else:
-                val_list = list(strat)
-            strat_df = data[data[strat_columns].isin(val_list).all(axis=1)].reset_index(drop=True)
-            ab_group_size = int(round(group_size * weight))
-            random_indexes_ab = np.random.choice([i for i in range(len(strat_df))], ab_group_size * 2, False)
-            a_indexes = random_indexes_ab[:ab_group_size]
-            b_indexes = random_indexes_ab[ab_group_size:]
-            a_random_strata_df = strat_df.iloc[a_indexes,:]
-            b_random_strata_df = strat_df.iloc[b_indexes,:]
-   
-            control = pd.concat([control, a_random_strata_df], ignore_index=True)
-            pilot = pd.concat([pilot, b_random_strata_df], ignore_index=True)
-    return (pilot, control)
\ No newline at end of file
+    rng = np.random.default_rng(seed)
+
+    with stage('factorize'):
+        strata_codes, strata_counts, strata_sizes = _get_strata_sizes(data, strat_columns, group_size, weights)
+    for code, ab_group_size in strata_sizes.items():
+        strat_count = strata_counts[code] if code < len(strata_counts) else 0
+        if ab_group_size * 2 > strat_count:
+            raise ValueError(
+                f'Not enough objects in stratum: {strat_count}, need {ab_group_size * 2}.'
+            )
+
+    with stage('sample'):
+        order, strata_starts = _get_strata_order(strata_codes, rng)
+
+        # первые ab_group_size перемешанных строк страты - в контроль, следующие - в пилот
+        codes = np.array([code for code, size in strata_sizes.items() if size > 0], dtype=int)
+        sizes = np.array([strata_sizes[code] for code in codes], dtype=int)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        a_positions = np.repeat(strata_starts[codes], sizes) + offsets
+        b_positions = a_positions + np.repeat(sizes, sizes)
+
+    with stage('gather'):
+        control = data.take(order[a_positions]).reset_index(drop=True)
+        pilot = data.take(order[b_positions]).reset_index(drop=True)
+    return (pilot, control)
+
+
+def select_stratified_indexes(
+    data, strat_columns, group_size, n_splits, weights=None, seed=None, max_block_elements=10000000
+):
+    """Подбирает сразу много независимых стратифицированных разбиений на пилот и контроль.
+
+    Страты факторизуются один раз, дальше для каждой страты выборки всех разбиений
+    генерируются одним массивом случайных ключей формы (n_splits, размер страты).
+    Результат можно передать в estimate_first_type_error_by_splits и
+    estimate_second_type_error_by_splits.
+
+    data - pd.DataFrame, датафрейм с описанием объектов, содержит атрибуты для стратификации.
+    strat_columns - List[str], список названий столбцов, по которым нужно стратифицировать.
+    group_size - int, размеры групп.
+    n_splits - int, кол-во разбиений.
+    weights - dict, словарь весов страт {strat: weight}, в том же формате, что и в select_stratified_groups.
+        Если None, определить веса пропорционально доле страт в датафрейме data.
+    seed - int, исходное состояние генератора случайных чисел для воспроизводимости результатов.
+    max_block_elements - int, максимальный размер массива случайных ключей,
+        который генерируется за раз. Ограничивает пиковую память для больших страт.
+
+    return (pilot_indexes, control_indexes) - два np.array формы (n_splits, размер группы)
+        с позиционными индексами строк data в пилотной и контрольной группах.
+    """
+    rng = np.random.default_rng(seed)
+
+    strata_codes, strata_counts, strata_sizes = _get_strata_sizes(data, strat_columns, group_size, weights)
+    strata_rows = np.argsort(strata_codes, kind='stable')
+    strata_starts = np.concatenate([[0], np.cumsum(strata_counts)[:-1]])
+
+    pilot_indexes, control_indexes = [], []
+    for code, ab_group_size in strata_sizes.items():
+        if ab_group_size == 0:
+            continue
+        strat_count = strata_counts[code] if code < len(strata_counts) else 0
+        if ab_group_size * 2 > strat_count:
+            raise ValueError(
+                f'Not enough objects in stratum: {strat_count}, need {ab_group_size * 2}.'
+            )
+        rows = strata_rows[strata_starts[code]:strata_starts[code] + strat_count]
+        block = max(1, max_block_elements // strat_count)
+        selected = []
+        for begin in range(0, n_splits, block):
+            keys = rng.random((min(block, n_splits - begin), strat_count))
+            # 2 * ab_group_size объектов с наименьшими ключами, упорядоченные по ключу
+            positions = np.argpartition(keys, ab_group_size * 2 - 1, axis=1)[:, :ab_group_size * 2]
+            order = np.argsort(np.take_along_axis(keys, positions, axis=1), axis=1)
+            selected.append(rows[np.take_along_axis(positions, order, axis=1)])
+        selected = np.vstack(selected)
+        control_indexes.append(selected[:, :ab_group_size])
+        pilot_indexes.append(selected[:, ab_group_size:])
+    return np.hstack(pilot_indexes), np.hstack(control_indexes)
+
+
+def get_strata_weights(data, strat_columns, weights=None):
+    """Вычисляет коды страт объектов и массив весов страт для стратифицированного среднего.
+
+    data - pd.DataFrame, датафрейм с описанием объектов, содержит атрибуты для стратификации.
+    strat_columns - List[str], список названий столбцов, по которым нужно стратифицировать.
+    weights - dict, словарь весов страт {strat: weight}, в том же формате, что и в select_stratified_groups.
+        Если None, определить веса пропорционально доле страт в датафрейме data.
+        Страты data, которых нет в weights, получают нулевой вес.
+
+    return (strata_codes, strata_weights):
+        strata_codes - np.array, код страты для каждой строки data
+        strata_weights - np.array, нормированные веса страт по кодам
+    """
+    strata_codes, strata_counts, weights_by_code = _get_strata_weights(data, strat_columns, weights)
+    strata_weights = np.zeros(len(strata_counts))
+    for code, weight in weights_by_code.items():
+        if code < len(strata_counts):
+            strata_weights[code] = weight
+    return strata_codes, strata_weights / strata_weights.sum()
+
+
+def calculate_stratified_moments(values, strata_codes, strata_weights, indexes, chunk_size=100):
+    """Вычисляет стратифицированное среднее и его дисперсию для набора выборок.
+
+    Средние и дисперсии всех страт во всех выборках считаются одной группировкой (np.bincount)
+    по коду (номер выборки, страта). Стратифицированное среднее - sum(w_h * mean_h),
+    его дисперсия - sum(w_h ** 2 * var_h / n_h). Веса страт, не попавших в выборку,
+    перераспределяются на остальные страты.
+
+    values - np.array, значения метрики всех объектов
+    strata_codes - np.array, код страты для каждого объекта
+    strata_weights - np.array, веса страт по кодам
+    indexes - np.array формы (n_splits, size), индексы объектов в каждой выборке
+    chunk_size - int, кол-во выборок, обрабатываемых за раз
+
+    return - (mean, se2), np.array длины n_splits со стратифицированными средними и их дисперсиями
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    # центрируем значения, чтобы не терять точность при вычитании квадратов
+    shift = values.mean()
+    values = values - shift
+    strata_weights = np.asarray(strata_weights, dtype=float)
+    n_strata = len(strata_weights)
+
+    mean, se2 = [], []
+    for begin in range(0, len(indexes), chunk_size):
+        chunk = indexes[begin:begin + chunk_size]
+        n_cells = len(chunk) * n_strata
+        codes = (np.arange(len(chunk))[:, None] * n_strata + strata_codes[chunk]).ravel()
+        chunk_values = values[chunk].ravel()
+        counts = np.bincount(codes, minlength=n_cells).reshape(len(chunk), n_strata)
+        sums = np.bincount(codes, weights=chunk_values, minlength=n_cells).reshape(len(chunk), n_strata)
+        sums_sq = np.bincount(codes, weights=chunk_values ** 2, minlength=n_cells).reshape(len(chunk), n_strata)
+
+        weights = strata_weights * (counts > 0)
+        weights = weights / weights.sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            strata_mean = np.where(counts > 0, sums / counts, 0)
+            strata_var = np.where(counts > 1, (sums_sq - counts * strata_mean ** 2) / (counts - 1), 0)
+            mean.append((weights * strata_mean).sum(axis=1) + shift)
+            se2.append(np.where(counts > 0, weights ** 2 * strata_var / counts, 0).sum(axis=1))
+    return np.concatenate(mean), np.concatenate(se2)
+
+
+def stratified_ttest(df_pilot, df_control, metric_name, strat_columns, weights=None):
+    """Проверяет гипотезу о равенстве средних по стратифицированным средним.
+
+    df_pilot - pd.DataFrame, датафрейм с данными пилотной группы
+    df_control - pd.DataFrame, датафрейм с данными контрольной группы
+    metric_name - str, название столбца с метрикой
+    strat_columns - List[str], список названий столбцов, по которым стратифицировали.
+    weights - dict, словарь весов страт {strat: weight}, в том же формате, что и в select_stratified_groups.
+        Если None, определить веса пропорционально доле страт в объединении групп.
+
+    return - (statistic, pvalue), статистика (control - pilot, как в ttest_ind(control, pilot)) и p-value
+    """
+    data = pd.concat([df_control, df_pilot], ignore_index=True)
+    strata_codes, strata_weights = get_strata_weights(data, strat_columns, weights)
+    control_indexes = np.arange(len(df_control)).reshape(1, -1)
+    pilot_indexes = np.arange(len(df_control), len(data)).reshape(1, -1)
+
+    values = data[metric_name].to_numpy()
+    a_mean, a_se2 = calculate_stratified_moments(values, strata_codes, strata_weights, control_indexes)
+    b_mean, b_se2 = calculate_stratified_moments(values, strata_codes, strata_weights, pilot_indexes)
+    statistic, pvalue = ttest_from_standard_errors(
+        a_mean, a_se2, b_mean, b_se2, len(df_control) + len(df_pilot) - 2
+    )
+    return statistic[0], pvalue[0]